@@ -0,0 +1,476 @@
+# benchmarks for flow generation and mask reconstruction
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import ndimage as ndimg
+import torch
+
+from utils import dynamics, metrics, relabel, transforms
+
+
+def synthetic_masks(shape=(1024, 1024), ncells=1000, radius=12, seed=0):
+    """ random cells: voronoi regions around random seeds cut to a maximum radius
+
+    Parameters
+    -------------
+
+    shape: tuple of int (optional, default (1024, 1024))
+        size of masks, 2D or 3D
+
+    ncells: int (optional, default 1000)
+        number of seeds
+
+    radius: float (optional, default 12)
+        maximum distance of mask pixels to their seed
+
+    seed: int (optional, default 0)
+        random seed
+
+    Returns
+    -------------
+
+    masks: int32, 2D or 3D array
+        labelled masks 0=NO masks; 1,2,...=mask labels
+
+    """
+    rs = np.random.RandomState(seed)
+    seeds = np.zeros(shape, np.int32)
+    pts = tuple(rs.randint(0, L, ncells) for L in shape)
+    seeds[pts] = np.arange(1, ncells+1, dtype=np.int32)
+    dist, inds = ndimg.distance_transform_edt(seeds==0, return_indices=True)
+    masks = seeds[tuple(inds)] * (dist < radius)
+    _, masks = np.unique(masks, return_inverse=True)
+    return masks.reshape(shape).astype(np.int32)
+
+def timeit(func, *args, nrep=3, **kwargs):
+    """ best wall-clock time of func(*args, **kwargs) over nrep runs (first call warms up jit) """
+    out = func(*args, **kwargs)
+    tmin = np.inf
+    for _ in range(nrep):
+        tic = time.time()
+        func(*args, **kwargs)
+        tmin = min(tmin, time.time() - tic)
+    return tmin, out
+
+def bench_masks_to_flows(Ly=1024, Lx=1024, ncells=(100, 1000, 4000), nrep=3):
+    """ per-object python loop vs fused compiled kernel in masks_to_flows """
+    print('masks_to_flows %d x %d'%(Ly, Lx))
+    for n in ncells:
+        masks = synthetic_masks((Ly, Lx), n)
+        t_loop, (mu0, muc0) = timeit(dynamics.masks_to_flows, masks, fused=False, nrep=nrep)
+        t_fused, (mu1, muc1) = timeit(dynamics.masks_to_flows, masks, fused=True, nrep=nrep)
+        err = max(np.abs(mu0 - mu1).max(), np.abs(muc0 - muc1).max())
+        print('  ncells=%6d  loop %7.3fs  fused %7.3fs  speedup %5.1fx  max abs diff %.1e'%(
+              masks.max(), t_loop, t_fused, t_loop/t_fused, err))
+
+def bench_masks_to_flows_parallel(Ly=2048, Lx=2048, ncells=8000, n_workers=(1, 2, 4, 8), nrep=3):
+    """ fused masks_to_flows with threads over batches of objects """
+    masks = synthetic_masks((Ly, Lx), ncells)
+    print('masks_to_flows %d x %d, ncells=%d'%(Ly, Lx, masks.max()))
+    t_serial, (mu0, _) = timeit(dynamics.masks_to_flows, masks, n_workers=1, nrep=nrep)
+    for n in n_workers:
+        t, (mu1, _) = timeit(dynamics.masks_to_flows, masks, n_workers=n, nrep=nrep)
+        print('  n_workers=%2d  %7.3fs  speedup %5.1fx  identical %s'%(
+              n, t, t_serial/t, np.array_equal(mu0, mu1)))
+
+def bench_masks_to_flows_3D(shape=(64, 256, 256), ncells=400, nrep=3):
+    """ summed 2D flows over all planes vs native 3D diffusion in masks_to_flows """
+    masks = synthetic_masks(shape, ncells, radius=10)
+    print('masks_to_flows %s, ncells=%d'%('x'.join(map(str, shape)), masks.max()))
+    t_planes, (mu0, _) = timeit(dynamics.masks_to_flows, masks, nrep=nrep)
+    t_native, (mu1, _) = timeit(dynamics.masks_to_flows, masks, native3D=True, nrep=nrep)
+    # agreement of flow directions inside masks
+    mu0 /= 1e-20 + (mu0**2).sum(axis=0)**0.5
+    cos = (mu0 * mu1).sum(axis=0)[masks > 0]
+    print('  planes %7.3fs  native3D %7.3fs  speedup %5.1fx'%(t_planes, t_native, t_planes/t_native))
+    print('  cosine similarity of flows: mean %.3f, 5th percentile %.3f'%(
+          cos.mean(), np.percentile(cos, 5)))
+
+def bench_masks_to_flows_tol(Ly=1024, Lx=1024, ncells=300, radius=30, 
+                             tols=(1e-3, 3e-3, 1e-2, 3e-2), check_every=10, nrep=3):
+    """ fixed number of diffusion iterations vs convergence-based stopping in masks_to_flows """
+    masks = synthetic_masks((Ly, Lx), ncells, radius=radius)
+    print('masks_to_flows %d x %d, ncells=%d'%(Ly, Lx, masks.max()))
+    t_fixed, (mu0, _, n0) = timeit(dynamics.masks_to_flows, masks, return_niter=True, nrep=nrep)
+    print('  tol=None    %7.3fs  mean niter %6.1f'%(t_fixed, n0[1:][n0[1:]>0].mean()))
+    for tol in tols:
+        t, (mu1, _, n1) = timeit(dynamics.masks_to_flows, masks, tol=tol, check_every=check_every,
+                                 return_niter=True, nrep=nrep)
+        cos = (mu0 * mu1).sum(axis=0)[masks > 0]
+        print('  tol=%.0e   %7.3fs  mean niter %6.1f  cosine mean %.4f, 1st percentile %.4f'%(
+              tol, t, n1[1:][n1[1:]>0].mean(), cos.mean(), np.percentile(cos, 1)))
+
+def _flows_and_pixels(masks):
+    """ network-like flows (x5) from masks and the pixels to run dynamics on """
+    dP = 5. * dynamics.masks_to_flows(masks)[0].astype(np.float32)
+    inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32).T
+    return dP, inds
+
+def bench_steps2D_interp(Ly=1024, Lx=1024, ncells=1000, niter=200, nrep=3):
+    """ python loop over map_coordinates vs fused compiled kernel in steps2D_interp """
+    dP, inds = _flows_and_pixels(synthetic_masks((Ly, Lx), ncells))
+    p0 = inds.T.astype(np.float32)
+    print('steps2D_interp %d x %d, npixels=%d, niter=%d'%(Ly, Lx, p0.shape[1], niter))
+    t_loop, p_loop = timeit(lambda: dynamics.steps2D_interp(p0.copy(), dP, niter, fused=False), nrep=nrep)
+    t_fused, p_fused = timeit(lambda: dynamics.steps2D_interp(p0.copy(), dP, niter), nrep=nrep)
+    print('  loop %7.3fs  fused %7.3fs  speedup %5.1fx  identical %s'%(
+          t_loop, t_fused, t_loop/t_fused, np.array_equal(p_loop, p_fused)))
+
+def bench_follow_flows_tol(Ly=1024, Lx=1024, ncells=1000, tols=(0.1, 0.5, 1.0), niter=200, nrep=3):
+    """ fixed number of iterations vs active-set early termination in follow_flows """
+    masks = synthetic_masks((Ly, Lx), ncells)
+    # follow_flows moves pixels along -dP, unit flows as in get_masks (not the x5 network scale)
+    dP = -dynamics.masks_to_flows(masks)[0].astype(np.float32)
+    print('follow_flows %d x %d, ncells=%d'%(Ly, Lx, masks.max()))
+    t0, (p0, n0) = timeit(dynamics.follow_flows, dP, niter=niter, return_niter=True, nrep=nrep)
+    print('  tol=None  %7.3fs  niter %4d'%(t0, n0))
+    for tol in tols:
+        t, (p, n) = timeit(dynamics.follow_flows, dP, niter=niter, tol=tol, return_niter=True, nrep=nrep)
+        dist = ((p - p0)**2).sum(axis=0)**0.5
+        print('  tol=%.1f   %7.3fs  niter %4d  speedup %5.1fx  pixels moved >1px from reference %.2f%%'%(
+              tol, t, n, t0/t, 100 * (dist > 1).mean()))
+
+def bench_follow_flows_torch(Ly=1024, Lx=1024, ncells=1000, nimg=4, niter=200, device='cpu', nrep=3):
+    """ numba dynamics per image vs batched torch dynamics on a device in follow_flows """
+    # unit flows as in get_masks, moved along -dP
+    dP = [-dynamics.masks_to_flows(synthetic_masks((Ly, Lx), ncells, seed=n))[0].astype(np.float32)
+          for n in range(nimg)]
+    print('follow_flows %d images %d x %d, device=%s, torch threads=%d'%(
+          nimg, Ly, Lx, device, torch.get_num_threads()))
+    t_numba, p0 = timeit(dynamics.follow_flows, dP, niter=niter, nrep=nrep)
+    t_torch, p1 = timeit(dynamics.follow_flows, dP, niter=niter, device=device, nrep=nrep)
+    dist = np.array([((p0[n] - p1[n])**2).sum(axis=0)**0.5 for n in range(nimg)])
+    print('  numba %7.3fs  torch %7.3fs  speedup %5.1fx  pixels >1px apart %.2f%%'%(
+          t_numba, t_torch, t_numba/t_torch, 100 * (dist > 1).mean()))
+
+def bench_follow_flows_3D(shape=(48, 192, 192), ncells=80, niter=200, tol=0.5, nrep=3):
+    """ nearest-voxel steps3D vs trilinear interpolated 3D dynamics (with and without tol) """
+    masks = synthetic_masks(shape, ncells, radius=10)
+    dP = -dynamics.masks_to_flows(masks, native3D=True)[0]
+    print('follow_flows %s, ncells=%d'%('x'.join(map(str, shape)), masks.max()))
+    for name, kwargs in [('nearest', dict()), ('interp', dict(interp=True)),
+                         ('interp tol=%.1f'%tol, dict(interp=True, tol=tol))]:
+        t, (p, n) = timeit(dynamics.follow_flows, dP, niter=niter, return_niter=True, nrep=nrep, **kwargs)
+        ap = metrics.average_precision(masks, dynamics.get_masks(p))[0]
+        print('  %-16s %7.3fs  niter %4d  AP@0.5 %.3f'%(name, t, n, ap[0]))
+
+def _dynamics_output(ncells, radius=12):
+    """ final pixel locations after dynamics for synthetic masks at a fixed density of cells """
+    L = int(np.ceil((ncells * (2 * radius)**2)**0.5))
+    masks = synthetic_masks((L, L), ncells, radius=radius)
+    dP = -dynamics.masks_to_flows(masks)[0].astype(np.float32)
+    return masks, dynamics.follow_flows(dP, tol=0.5)
+
+def bench_get_masks(ncells=(100, 1000, 5000, 20000), nrep=3):
+    """ python loop over seeds vs compiled seed growing in get_masks """
+    print('get_masks')
+    for n in ncells:
+        masks, p = _dynamics_output(n)
+        t_loop, M0 = timeit(lambda: dynamics.get_masks(p.copy(), fused=False), nrep=nrep)
+        t_fused, M1 = timeit(lambda: dynamics.get_masks(p.copy()), nrep=nrep)
+        print('  %d x %d, ncells=%6d  loop %7.3fs  fused %7.3fs  speedup %5.1fx  identical %s'%(
+              masks.shape[0], masks.shape[1], masks.max(), t_loop, t_fused, t_loop/t_fused, 
+              np.array_equal(M0, M1)))
+
+def peak_memory(func, *args, **kwargs):
+    """ peak memory in bytes allocated by numpy (traced by tracemalloc) while running func """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    out = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, out
+
+def bench_get_masks_sparse(nrep=3):
+    """ dense vs sparse convergence histogram in get_masks (time and peak memory) """
+    print('get_masks dense vs sparse histogram')
+    for shape, ncells in [((4096, 4096), 2000), ((96, 512, 512), 300)]:
+        masks = synthetic_masks(shape, ncells, radius=10)
+        dP = -dynamics.masks_to_flows(masks, native3D=True)[0].astype(np.float32)
+        p = dynamics.follow_flows(dP, tol=0.5)
+        for sparse in [False, True]:
+            t, M = timeit(lambda: dynamics.get_masks(p.copy(), sparse=sparse), nrep=nrep)
+            # memory of mask creation (excluding the copy of p)
+            pc = p.copy()
+            mem, M = peak_memory(dynamics.get_masks, pc, sparse=sparse)
+            if not sparse:
+                M_dense = M
+            print('  %-12s sparse=%-5s %7.3fs  peak memory %7.1f MB  identical %s'%(
+                  'x'.join(map(str, shape)), sparse, t, mem / 1024**2, np.array_equal(M, M_dense)))
+
+def bench_remove_bad_flow_masks(Ly=1024, Lx=1024, ncells=(100, 1000, 4000), nrep=3):
+    """ per-label flow error and bad mask removal """
+    print('remove_bad_flow_masks %dx%d'%(Ly, Lx))
+    for n in ncells:
+        masks = synthetic_masks((Ly, Lx), n)
+        dP = 5 * dynamics.masks_to_flows(masks)[0].astype(np.float32)
+        dP += np.random.RandomState(0).randn(*dP.shape).astype(np.float32)
+        t_err, _ = timeit(metrics.flow_error, masks, dP, nrep=nrep)
+        t_rm, M = timeit(lambda: dynamics.remove_bad_flow_masks(masks.copy(), dP), nrep=nrep)
+        print('  ncells=%-6d flow_error %7.3fs  remove_bad_flow_masks %7.3fs  removed %d'%(
+              masks.max(), t_err, t_rm, masks.max() - len(np.unique(M)) + 1))
+
+def bench_relabel(nrep=3):
+    """ np.unique vs bincount/lookup table relabelling of images with 10k labels """
+    print('relabel np.unique vs lookup table')
+    for shape in [(2048, 2048), (32, 1024, 1024)]:
+        masks = synthetic_masks(shape, 10000, radius=12)
+        rs = np.random.RandomState(0)
+        masks[masks > 0] *= 3  # non-sequential labels
+        big = rs.choice(np.unique(masks)[1:], 100, replace=False)
+        name = 'x'.join(map(str, shape))
+        def unique_relabel(M):
+            return np.reshape(np.unique(M, return_inverse=True)[1], M.shape)
+        def unique_remove(M):
+            M = M.copy()
+            for i in big:
+                M[M==i] = 0
+            return unique_relabel(M)
+        def unique_filter(M):
+            uniq, counts = np.unique(M, return_counts=True)
+            M = M.copy()
+            M[np.isin(M, uniq[counts < 200])] = 0
+            return unique_relabel(M)
+        for label, old, new in [
+                ('relabel', unique_relabel, relabel.relabel_sequential),
+                ('remove 100', unique_remove, lambda M: relabel.remove_labels(M, big, relabel=True)),
+                ('size filter', unique_filter, lambda M: relabel.filter_sizes(M, min_size=200))]:
+            t_old, M_old = timeit(old, masks, nrep=nrep)
+            t_new, M_new = timeit(new, masks, nrep=nrep)
+            print('  %-14s %-12s np.unique %7.3fs  lut %7.3fs  identical %s'%(
+                  name, label, t_old, t_new, np.array_equal(M_old, M_new)))
+
+def _worker_pid(_):
+    """ runs in a spawned worker after it imported this module (and utils.dynamics) """
+    return os.getpid()
+
+def bench_worker_startup(n_workers=(1, 2, 4), nrep=1):
+    """ time to spawn a process pool and import utils.dynamics (compiled kernels from cache) in each worker """
+    print('spawn process pool and import utils.dynamics')
+    ctx = multiprocessing.get_context('spawn')
+    for n in n_workers:
+        def startup():
+            with ProcessPoolExecutor(max_workers=n, mp_context=ctx) as pool:
+                return len(set(pool.map(_worker_pid, range(4 * n))))
+        t, _ = timeit(startup, nrep=nrep)
+        print('  n_workers=%d %7.3fs'%(n, t))
+
+def bench_get_masks_chunked(Ly=2048, Lx=2048, ncells=4000, chunk=512, overlap=48, 
+                            n_workers=(1, 2, 4), nrep=1):
+    """ whole image vs chunked dynamics and mask creation (time, peak memory and AP) """
+    print('follow_flows + get_masks whole vs chunked %dx%d'%(Ly, Lx))
+    masks = synthetic_masks((Ly, Lx), ncells, radius=12)
+    dP = -dynamics.masks_to_flows(masks)[0].astype(np.float32)
+    # flows read from a memory-mapped file
+    tmpdir = tempfile.mkdtemp()
+    np.save(os.path.join(tmpdir, 'dP.npy'), dP)
+    dP = np.load(os.path.join(tmpdir, 'dP.npy'), mmap_mode='r')
+    whole = lambda: dynamics.get_masks(dynamics.follow_flows(np.array(dP)))
+    t, M = timeit(whole, nrep=nrep)
+    mem, _ = peak_memory(whole)
+    print('  whole               %7.3fs  peak memory %7.1f MB  AP@0.5 %0.3f'%(
+          t, mem / 1024**2, metrics.average_precision(masks, M)[0][0]))
+    filename = os.path.join(tmpdir, 'masks.npy')
+    t1 = None
+    for n in n_workers:
+        # time includes spawning the pool (workers load compiled kernels from the numba cache)
+        chunked = lambda: dynamics.get_masks_chunked(dP, chunk=chunk, overlap=overlap, 
+                                                     n_workers=n, filename=filename)
+        t, Mc = timeit(chunked, nrep=nrep)
+        t1 = t if t1 is None else t1
+        mem, _ = peak_memory(chunked)
+        print('  chunked n_workers=%d %7.3fs (x%.2f)  peak memory %7.1f MB  AP@0.5 %0.3f  AP@0.5 vs whole %0.3f'%(
+              n, t, t1 / t, mem / 1024**2, metrics.average_precision(masks, np.asarray(Mc))[0][0], 
+              metrics.average_precision(M, np.asarray(Mc))[0][0]))
+    print('  (%d CPU cores)'%os.cpu_count())
+    shutil.rmtree(tmpdir)
+
+def bench_get_masks_pointer(noise=(0, 0.3), nrep=3):
+    """ pointer jumping vs euler integration (follow_flows + get_masks): time and AP """
+    print('get_masks_pointer vs follow_flows + get_masks')
+    for shape, ncells in [((1024, 1024), 1500), ((64, 256, 256), 300)]:
+        masks = synthetic_masks(shape, ncells, radius=10)
+        mu = -dynamics.masks_to_flows(masks, native3D=True)[0].astype(np.float32)
+        rs = np.random.RandomState(0)
+        for sigma in noise:
+            # noisy flows, zero outside cells (as when masked by cell probability)
+            dP = (mu + sigma * rs.randn(*mu.shape).astype(np.float32)) * (masks > 0)
+            t_euler, M_euler = timeit(lambda: dynamics.get_masks(dynamics.follow_flows(dP)), nrep=nrep)
+            t_ptr, M_ptr = timeit(dynamics.get_masks_pointer, dP, masks > 0, nrep=nrep)
+            ap_euler = metrics.average_precision(masks, M_euler)[0]
+            ap_ptr = metrics.average_precision(masks, M_ptr)[0]
+            print('  %-12s noise %0.1f  euler %7.3fs AP %s  pointer %7.3fs AP %s  AP vs euler %s'%(
+                  'x'.join(map(str, shape)), sigma, t_euler, np.round(ap_euler, 3), t_ptr, 
+                  np.round(ap_ptr, 3), np.round(metrics.average_precision(M_euler, M_ptr)[0], 3)))
+
+def bench_make_tiles(Ly=4000, Lx=4000, nrep=3):
+    """ dense vs lazy tiles in make_tiles (time and peak memory) """
+    print('make_tiles %dx%d'%(Ly, Lx))
+    img = np.random.RandomState(0).rand(2, Ly, Lx).astype(np.float32)
+    for augment in [False, True]:
+        for lazy in [False, True]:
+            t, _ = timeit(transforms.make_tiles, img, augment=augment, lazy=lazy, nrep=nrep)
+            mem, (IMG, ysub, xsub, _, _) = peak_memory(transforms.make_tiles, img, augment=augment, lazy=lazy)
+            print('  augment=%-5s lazy=%-5s ntiles %4d  %7.3fs  peak memory %7.1f MB'%(
+                  augment, lazy, len(ysub), t, mem / 1024**2))
+
+def bench_average_tiles(Ly=3000, Lx=3000, batch_size=8, nrep=3):
+    """ average_tiles over all tile outputs vs streaming TileAccumulator (time and peak memory) """
+    print('average_tiles vs TileAccumulator %dx%d'%(Ly, Lx))
+    # network output of each tile is the tile of a 3 channel image
+    img = np.random.RandomState(0).rand(3, Ly, Lx).astype(np.float32)
+    def all_tiles(augment):
+        IMG, ysub, xsub, Ly_, Lx_ = transforms.make_tiles(img, augment=augment)
+        y = transforms.unaugment_tiles(IMG, unet=False) if augment else IMG
+        return transforms.average_tiles(y.reshape((-1,) + y.shape[2:]), ysub, xsub, Ly_, Lx_)
+    def streaming(augment):
+        IMG, ysub, xsub, Ly_, Lx_ = transforms.make_tiles(img, augment=augment, lazy=True)
+        acc = transforms.TileAccumulator(ysub, xsub, Ly_, Lx_, 3, augment=augment, nx=IMG.shape[1])
+        for inds, batch in IMG.batches(batch_size):
+            acc.add(batch, inds)
+        return acc.result()
+    for augment in [False, True]:
+        for name, func in [('average_tiles', all_tiles), ('TileAccumulator', streaming)]:
+            t, yf = timeit(func, augment, nrep=nrep)
+            mem, _ = peak_memory(func, augment)
+            print('  augment=%-5s %-16s %7.3fs  peak memory %7.1f MB'%(augment, name, t, mem / 1024**2))
+
+def bench_run_tiled(Ly=512, Lx=512, batch_sizes=(1, 4, 8), nrep=1):
+    """ tiled inference with CellPosenet (random weights): stage timings for batch sizes """
+    from model.model import CellPosenet
+    from model.inference import run_tiled
+    print('run_tiled %dx%d'%(Ly, Lx))
+    torch.manual_seed(0)
+    net = CellPosenet([2, 32, 64, 128, 256], 3, 3)
+    img = np.random.RandomState(0).rand(2, Ly, Lx).astype(np.float32)
+    for augment in [False, True]:
+        for batch_size in batch_sizes:
+            _, (yf, style, timings) = timeit(run_tiled, net, img, batch_size=batch_size, 
+                                             augment=augment, return_timings=True, nrep=nrep)
+            print('  augment=%-5s batch_size=%-3d '%(augment, batch_size) + 
+                  '  '.join('%s %6.3fs'%(k, v) for k, v in timings.items()))
+
+def bench_random_rotate_and_resize(Ly=512, Lx=512, batch_size=8, nrep=3):
+    """ per-image random_rotate_and_resize (cv2) vs batched random_rotate_and_resize_torch """
+    print('random_rotate_and_resize %d images %dx%d'%(batch_size, Ly, Lx))
+    rs = np.random.RandomState(0)
+    X = rs.rand(batch_size, 2, Ly, Lx).astype(np.float32)
+    Y = rs.rand(batch_size, 3, Ly, Lx).astype(np.float32)
+    def per_image(fused):
+        return [transforms.random_rotate_and_resize(x, y, scale_range=0.5, fused=fused) 
+                for x, y in zip(X, Y)]
+    for fused in [False, True]:
+        t, _ = timeit(per_image, fused, nrep=nrep)
+        print('  %-16s %7.3fs'%('cv2 fused=%s'%fused, t))
+    Xt, Yt = torch.from_numpy(X), torch.from_numpy(Y)
+    t, _ = timeit(transforms.random_rotate_and_resize_torch, Xt, Yt, scale_range=0.5, nrep=nrep)
+    print('  %-16s %7.3fs'%('torch', t))
+
+def bench_normalize99(Ly=4000, Lx=4000, nrep=3):
+    """ legacy normalize99 (three np.percentile calls) vs exact / approximate percentiles in one pass """
+    print('normalize99 %dx%d'%(Ly, Lx))
+    rs = np.random.RandomState(0)
+    imgs = {'uint16': rs.poisson(200, (Ly, Lx)).astype(np.uint16), 
+            'float32': rs.gamma(2, 100, (Ly, Lx)).astype(np.float32)}
+    def legacy(img):
+        X = img.copy()
+        return (X - np.percentile(X, 1)) / (np.percentile(X, 99) - np.percentile(X, 1))
+    for name, img in imgs.items():
+        t, X0 = timeit(legacy, img, nrep=nrep)
+        print('  %-8s %-12s %7.3fs'%(name, 'legacy', t))
+        for approximate in [False, True]:
+            t, X = timeit(transforms.normalize99, img, approximate=approximate, nrep=nrep)
+            # error in rank of percentiles and in normalized intensities
+            p = transforms.percentiles(img, approximate=approximate)
+            rank = np.array([(img < pk).mean() for pk in p]) * 100 - [1, 99]
+            print('  %-8s %-12s %7.3fs  percentile rank error %s  max error %.2e'%(
+                  name, 'approximate' if approximate else 'exact', t, 
+                  np.round(rank, 3), np.abs(X - X0).max()))
+        buf = img.astype(np.float32)
+        t, _ = timeit(transforms.normalize99, buf, approximate=True, out=buf, nrep=1)
+        print('  %-8s %-12s %7.3fs'%(name, 'in place', t))
+
+def bench_reshape(Ly=4000, Lx=4000, nchan=4, nrep=3):
+    """ legacy reshape (float32 copy of all channels) vs channel selection into new / pooled buffers """
+    from utils.cache import BufferPool
+    print('reshape %dx%dx%d uint16'%(Ly, Lx, nchan))
+    img = np.random.RandomState(0).randint(0, 2**16, (Ly, Lx, nchan)).astype(np.uint16)
+    def legacy(data, channels=[2, 1]):
+        data = data.astype(np.float32)
+        data = data[..., [channels[0]-1, channels[1]-1]]
+        return np.transpose(data, (2, 0, 1))
+    pool = BufferPool()
+    for name, func, kwargs in [('legacy', legacy, {}), 
+                               ('new', transforms.reshape, dict(channels=[2, 1], chan_first=True)),
+                               ('pool', transforms.reshape, dict(channels=[2, 1], chan_first=True, pool=pool))]:
+        t, _ = timeit(func, img, nrep=nrep, **kwargs)
+        mem, _ = peak_memory(func, img, **kwargs)
+        print('  %-8s %7.3fs  peak memory %7.1f MB'%(name, t, mem / 1024**2))
+
+def bench_pad_image_ND(Ly=3000, Lx=3000, nimg=10, nrep=3):
+    """ pad_image_ND with np.pad vs into pooled arrays / (pinned) tensors, streaming same-size images """
+    from utils.cache import BufferPool, TorchBufferPool
+    print('pad_image_ND %d images %dx%d'%(nimg, Ly, Lx))
+    imgs = [np.random.RandomState(n).rand(2, Ly, Lx).astype(np.float32) for n in range(2)]
+    for name, pool in [('np.pad', None), ('BufferPool', BufferPool()), ('TorchBufferPool', TorchBufferPool())]:
+        def stream():
+            for n in range(nimg):
+                I, slc = transforms.pad_image_ND(imgs[n % 2], pool=pool)
+                I = I if pool is not None and not isinstance(I, np.ndarray) else torch.from_numpy(I)
+                I.unsqueeze(0)
+        t, _ = timeit(stream, nrep=nrep)
+        print('  %-16s %7.3fs per image'%(name, t / nimg))
+
+def bench_resize_image(shape=(100, 512, 512, 2), rsz=2., n_workers=(1, 4), nrep=3):
+    """ resize_image of uint16 stacks: threads over planes and float32 vs uint16 output """
+    print('resize_image %s uint16 x %.1f'%(shape, rsz))
+    img = np.random.RandomState(0).randint(0, 2**16, shape).astype(np.uint16)
+    for keep_dtype in [False, True]:
+        for n in n_workers:
+            t, _ = timeit(transforms.resize_image, img, rsz=rsz, n_workers=n, keep_dtype=keep_dtype, nrep=nrep)
+            mem, _ = peak_memory(transforms.resize_image, img, rsz=rsz, n_workers=n, keep_dtype=keep_dtype)
+            print('  keep_dtype=%-5s n_workers=%d %7.3fs  peak memory %7.1f MB'%(
+                  keep_dtype, n, t, mem / 1024**2))
+
+
+BENCHMARKS = {
+    'masks_to_flows': bench_masks_to_flows,
+    'masks_to_flows_parallel': bench_masks_to_flows_parallel,
+    'masks_to_flows_3D': bench_masks_to_flows_3D,
+    'masks_to_flows_tol': bench_masks_to_flows_tol,
+    'steps2D_interp': bench_steps2D_interp,
+    'follow_flows_tol': bench_follow_flows_tol,
+    'follow_flows_torch': bench_follow_flows_torch,
+    'follow_flows_3D': bench_follow_flows_3D,
+    'get_masks': bench_get_masks,
+    'get_masks_sparse': bench_get_masks_sparse,
+    'remove_bad_flow_masks': bench_remove_bad_flow_masks,
+    'relabel': bench_relabel,
+    'worker_startup': bench_worker_startup,
+    'get_masks_chunked': bench_get_masks_chunked,
+    'get_masks_pointer': bench_get_masks_pointer,
+    'make_tiles': bench_make_tiles,
+    'average_tiles': bench_average_tiles,
+    'run_tiled': bench_run_tiled,
+    'random_rotate_and_resize': bench_random_rotate_and_resize,
+    'normalize99': bench_normalize99,
+    'reshape': bench_reshape,
+    'pad_image_ND': bench_pad_image_ND,
+    'resize_image': bench_resize_image,
+}
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Cellpose benchmarks')
+    args.add_argument('bench', nargs='*', default=list(BENCHMARKS),
+                      help='benchmarks to run (default: all): ' + ', '.join(BENCHMARKS))
+    args.add_argument('--nrep', default=3, type=int,
+                      help='number of timed repetitions (default: 3)')
+    args = args.parse_args()
+    for name in args.bench:
+        BENCHMARKS[name](nrep=args.nrep)
@@ -4,12 +4,14 @@ import numpy as np
 import torch
 from torch.utils.data import Dataset
 from utils import dynamics, plot, transforms
+from utils.cache import FlowCache, BufferPool
 import torchvision.transforms as T
 from pycocotools.coco import COCO
 
 
 class CellDataset(Dataset):
-    def __init__(self, data_dir, train=True):
+    def __init__(self, data_dir, train=True, flow_cache_dir=None, flow_cache_size=10 * 1024**3,
+                 batch_augment=False):
         '''
         cell dataset dictory structure
         - {data_dir}/
@@ -19,9 +21,22 @@ class CellDataset(Dataset):
           - val/
             - annotation.json
             - images/
+
+        if flow_cache_dir is not None, flows computed from the masks are cached 
+        there (at most flow_cache_size bytes) and reused in later epochs
+
+        if batch_augment, training images and labels are returned without 
+        random rotation and resizing, which is done on collated batches 
+        (`pad_collate`) with `transforms.random_rotate_and_resize_torch`
         '''
         super().__init__()
         self.train = train
+        self.batch_augment = batch_augment
+        self.flow_cache = None
+        if flow_cache_dir is not None:
+            self.flow_cache = FlowCache(flow_cache_dir, max_bytes=flow_cache_size)
+        # reshaped images are written into reused buffers (copied by the augmentation / padding)
+        self.buffer_pool = BufferPool()
 
         if self.train:
             # train mode
@@ -93,7 +108,7 @@ class CellDataset(Dataset):
 
     def get_target(self, img_id):
         # return target.shape: [4, Ly, Lx]
-        # target[0] is masks, target[1] is cell_probability, target[2] is flow Y, target[3] is flow X.
+        # target[0] is masks, target[1] is flow Y, target[2] is flow X, target[3] is cell_probability.
         img_id = int(img_id)
         ann_ids = self.coco.getAnnIds(img_id)
         anns = self.coco.loadAnns(ann_ids)
@@ -108,7 +123,7 @@ class CellDataset(Dataset):
             masks = self.mask_convert(masks)
 
             # mask to flows, flows.shape: list of [4 x Ly x Lx] arrays
-            flows = dynamics.labels_to_flows([masks], files=None)
+            flows = dynamics.labels_to_flows([masks], files=None, cache=self.flow_cache)
             target = flows[0]
             return target
         else:
@@ -117,10 +132,16 @@ class CellDataset(Dataset):
     def transform(self, img, label=None):
         # dataset argument
         # step1: reshape and normalize data
-        img = transforms.reshape_and_normalize_data(img, channels=[2, 1], normalize=True)
+        img = transforms.reshape_and_normalize_data(img, channels=[2, 1], normalize=True,
+                                                    pool=self.buffer_pool)
         # step2: random rotate and resize
-        if self.train and label is not None:
-            img, label = transforms.random_rotate_and_resize(img, label[1:], scale_range=0.5)
+        if self.train and label is not None and self.batch_augment:
+            # augmented on collated batches, labels as [cell probability, Y flow, X flow]
+            img, label = map(torch.from_numpy, [img.astype(np.float32), label[[3, 1, 2]].astype(np.float32)])
+            return img, label
+        elif self.train and label is not None:
+            # labels are augmented and returned as [cell probability, Y flow, X flow]
+            img, label = transforms.random_rotate_and_resize(img, label[[3, 1, 2]], scale_range=0.5)
             img, label = map(torch.from_numpy, [img, label])
             return img, label
         else:
@@ -1,12 +1,35 @@
+import torch
 from torchvision import datasets, transforms
+from torch.utils.data.dataloader import default_collate
 from base import BaseDataLoader
 from data_loader import cell_datasets
 
+
+def pad_collate(batch):
+    """
+    collate images and labels of different sizes by zero-padding them at the bottom 
+    and right, returns images, labels and sizes of images before padding [nimg x 2]
+    """
+    shapes = torch.tensor([img.shape[-2:] for img, _ in batch])
+    Ly, Lx = shapes.max(dim=0).values.tolist()
+    data = batch[0][0].new_zeros((len(batch), batch[0][0].shape[0], Ly, Lx))
+    target = batch[0][1].new_zeros((len(batch), batch[0][1].shape[0], Ly, Lx))
+    for n, (img, label) in enumerate(batch):
+        data[n, :, :img.shape[-2], :img.shape[-1]] = img
+        target[n, :, :label.shape[-2], :label.shape[-1]] = label
+    return data, target, shapes
+
 class CellDataLoader(BaseDataLoader):
     """
     Cell data loading demo using BaseDataLoader
     """
-    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, training=True):
+    def __init__(self, data_dir, batch_size, shuffle=True, validation_split=0.0, num_workers=1, training=True,
+                 flow_cache_dir=None, flow_cache_size=10 * 1024**3, batch_augment=False):
         self.data_dir = data_dir
-        self.dataset = cell_datasets.CellDataset(data_dir=self.data_dir, train=training)
-        super().__init__(self.dataset, batch_size, shuffle, validation_split, num_workers)
\ No newline at end of file
+        self.dataset = cell_datasets.CellDataset(data_dir=self.data_dir, train=training,
+                                                 flow_cache_dir=flow_cache_dir,
+                                                 flow_cache_size=flow_cache_size,
+                                                 batch_augment=batch_augment and training)
+        collate_fn = pad_collate if batch_augment and training else default_collate
+        super().__init__(self.dataset, batch_size, shuffle, validation_split, num_workers,
+                         collate_fn=collate_fn)
\ No newline at end of file
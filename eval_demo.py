@@ -1,13 +1,15 @@
 # demo for evaluator
 import argparse
 import os
-from utils import transforms, render
+from utils import transforms, render, dynamics
 import numpy as np
 from PIL import Image
 from scipy import ndimage as ndimg
 import matplotlib.pyplot as plt
 
 import model.model as module_arch
+from model.inference import run_tiled
+from utils.cache import TorchBufferPool
 import torch
 from tqdm import tqdm
 
@@ -44,29 +46,24 @@ def inference(config):
     model.eval()
 
     # step3: start loop inference
+    # padded images and batches of tiles are reused across images of the same size
+    pool = TorchBufferPool(pin_memory=device.type == 'cuda')
     for img_i in tqdm(img_list):
-        inference_single(img_i, model, device)
+        inference_single(img_i, model, device, pool=pool)
 
 
-def inference_single(img_path, model, device):
+def inference_single(img_path, model, device, batch_size=8, augment=False, pool=None):
     # 3.1 read the image
     image = Image.open(img_path)
     image = np.array(image.convert('RGB'))
 
     # 3.2 pre-process the image
     img = transforms.reshape_and_normalize_data(image, channels=[0, 0], normalize=True)
-    img, slc = transforms.pad_image_ND(img)
-    img = np.expand_dims(img, axis=0)
-    img = torch.from_numpy(img)
 
-    # 3.3 model forward
-    output, style = model(img.to(device))
-    output = output[0].detach().cpu().numpy()
-    style = style[0].detach().cpu().numpy()
+    # 3.3 model forward on batches of tiles (model is on device)
+    output, style = run_tiled(model, img, batch_size=batch_size, augment=augment, pool=pool)
 
     # 3.4 post-process the model output
-    # remove padding
-    output = output[slc]
     # transpose so the channel is last axis
     output = np.transpose(output, (1, 2, 0))
 
@@ -78,44 +75,13 @@ def inference_single(img_path, model, device):
     pass
 
 def flow2msk(flowp, level=0.5, grad=0.5, area=None, volume=None):
+    """ masks from network output [Ly x Lx x (flows, cellprob)] by pointer jumping """
     flowp = np.asarray(flowp)
-    shp, dim = flowp.shape[:-1], flowp.ndim - 1
-    l = np.linalg.norm(flowp[:,:,:2], axis=-1)
-    flow = flowp[:,:,:2]/l.reshape(shp+(1,))
-    flow[(flowp[:,:,2]<level)|(l<grad)] = 0
-    ss = ((slice(None),) * (dim) + ([0,-1],)) * 2
-    for i in range(dim):flow[ss[dim-i:-i-2]+(i,)]=0
-    sn = np.sign(flow); sn *= 0.5; flow += sn;
-    dn = flow.astype(np.int32).reshape(-1, dim)
-    strides = np.cumprod(np.array((1,)+shp[::-1]))
-    dn = (strides[-2::-1] * dn).sum(axis=-1)
-    rst = np.arange(flow.size//dim); rst += dn
-    for i in range(10): rst = rst[rst]
-    hist = np.bincount(rst, None, len(rst))
-    hist = hist.astype(np.uint32).reshape(shp)
-    lab, n = ndimg.label(hist, np.ones((3,)*dim))
-    volumes = ndimg.sum(hist, lab, np.arange(n+1))
-    areas = np.bincount(lab.ravel())
-    mean, std = estimate_volumes(volumes, 2)
-    if not volume: volume = max(mean-std*3, 50)
-    if not area: area = volumes // 3
-    msk = (areas<area) & (volumes>volume)
-    lut = np.zeros(n+1, np.uint32)
-    lut[msk] = np.arange(1, msk.sum()+1)
-    return lut[lab].ravel()[rst].reshape(shp)
-    return hist, lut[lab], mask
-
-
-def estimate_volumes(arr, sigma=3):
-    msk = arr > 50
-    idx = np.arange(len(arr), dtype=np.uint32)
-    idx, arr = idx[msk], arr[msk]
-    for k in np.linspace(5, sigma, 5):
-       std = arr.std()
-       dif = np.abs(arr - arr.mean())
-       msk = dif < std * k
-       idx, arr = idx[msk], arr[msk]
-    return arr.mean(), arr.std()
+    dim = flowp.ndim - 1
+    # pixels move along the network flows, dynamics move along -dP
+    dP = -np.moveaxis(flowp[..., :dim], -1, 0)
+    return dynamics.get_masks_pointer(dP, cellprob=flowp[..., dim], level=level, grad=grad, 
+                                      area=area, volume=volume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+import time
+import numpy as np
+import torch
+
+from utils import transforms
+
+
+def run_tiled(net, imgi, batch_size=8, augment=False, bsize=224, tile_overlap=0.1,
+              return_timings=False, pool=None):
+    """ run network in tiles of image in batches and average over tiles
+
+    The image is padded to a multiple of 16, cut into tiles (`make_tiles`
+    with lazy=True) that are copied and sent to the device of the network
+    one batch at a time, and the outputs are averaged over tiles with a
+    `TileAccumulator` as they come back.
+
+    Parameters
+    -------------
+
+    net: torch.nn.Module
+        CellPosenet (or DataParallel of it) returning output and style
+
+    imgi: float32, 3D array
+        normalized image [nchan x Ly x Lx]
+
+    batch_size: int (optional, default 8)
+        number of tiles run through the network at once
+
+    augment: bool (optional, default False)
+        tiles overlap by half of their size and are flipped (4 flips),
+        outputs are flipped back before averaging
+
+    bsize: int (optional, default 224)
+        size of tiles
+
+    tile_overlap: float (optional, default 0.1)
+        fraction of overlap of tiles (if augment is False)
+
+    return_timings: bool (optional, default False)
+        also return time spent in each stage
+
+    pool: utils.cache.BufferPool or TorchBufferPool (optional, default None)
+        if not None, the padded image and the batches of tiles are written into 
+        arrays (or pinned tensors) from pool, reused by later calls with images of the same 
+        padded size, instead of newly allocated arrays
+
+    Returns
+    -------------
+
+    yf: float32, 3D array
+        network output averaged over tiles [nout x Ly x Lx],
+        yf[0] is Y flow; yf[1] is X flow; yf[2] is cell probability
+
+    style: float32, 1D array
+        style of image averaged over tiles (L2 normalized)
+
+    timings: dict
+        seconds spent tiling ('tiles'), in the network including transfers
+        to and from the device ('network'), averaging tiles ('average') and
+        in total ('total') (only returned if return_timings)
+
+    """
+    tic = time.time()
+    timings = dict.fromkeys(['tiles', 'network', 'average'], 0.)
+    device = next(net.parameters()).device
+    training = net.training
+    net.eval()
+
+    img, slc = transforms.pad_image_ND(np.asarray(imgi, np.float32), pool=pool)
+    if not isinstance(img, np.ndarray):
+        img = img.numpy()
+    IMG, ysub, xsub, Ly, Lx = transforms.make_tiles(img, bsize=bsize, augment=augment,
+                                                   tile_overlap=tile_overlap, lazy=True)
+    shape = (min(batch_size, len(IMG)),) + IMG.shape[2:]
+    if pool is not None:
+        batch = pool.get(shape, np.float32)
+        if isinstance(batch, np.ndarray):
+            batch_t = torch.from_numpy(batch)
+        else:
+            batch_t, batch = batch, batch.numpy()
+    else:
+        batch = np.empty(shape, np.float32)
+        batch_t = torch.from_numpy(batch)
+    acc, style = None, 0
+    timings['tiles'] += time.time() - tic
+    try:
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for k0 in range(0, len(IMG), batch_size):
+                t0 = time.time()
+                inds = np.arange(k0, min(k0 + batch_size, len(IMG)))
+                IMG.batch(inds, out=batch[:len(inds)])
+                t1 = time.time()
+                # batch_t shares memory with batch (pinned if from pool)
+                y, styles = net(batch_t[:len(inds)].to(device, non_blocking=True))
+                y = y.cpu().numpy()
+                styles = styles.cpu().numpy()
+                t2 = time.time()
+                if acc is None:
+                    acc = transforms.TileAccumulator(ysub, xsub, Ly, Lx, y.shape[1],
+                                                     augment=augment, nx=IMG.shape[1])
+                acc.add(y, inds)
+                style = style + styles.sum(axis=0)
+                timings['tiles'] += t1 - t0
+                timings['network'] += t2 - t1
+                timings['average'] += time.time() - t2
+    finally:
+        net.train(training)
+
+    t0 = time.time()
+    yf = acc.result()
+    # remove padding
+    yf = yf[(slice(None),) + slc[-2:]]
+    style = style / len(IMG)
+    style /= (style**2).sum()**0.5
+    timings['average'] += time.time() - t0
+    timings['total'] = time.time() - tic
+    if return_timings:
+        return yf, style.astype(np.float32), timings
+    return yf, style.astype(np.float32)
@@ -16,11 +16,11 @@ def bce_loss(output, target):
 def loss_fn(lbl, y):
     """ loss function between true labels lbl and prediction y """
     # prediction y: [bz, 3, w, h], flow_y, flow_x, cell prob
-    # label lbl: [bz, 3, w, h], flow_y, flow_x, cell_prob
+    # label lbl: [bz, 3, w, h], cell_prob, flow_y, flow_x (see CellDataset.transform)
     # flows
-    flows = 5. * lbl[:, :2]
+    flows = 5. * lbl[:, 1:]
     # prob
-    prob = lbl[:, 2].abs()
+    prob = lbl[:, 0]
 
     loss = mse_loss(y[:, :2], flows)
     loss2 = bce_loss(y[:, 2], prob)
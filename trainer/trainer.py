@@ -3,6 +3,7 @@ import torch
 from torchvision.utils import make_grid
 from base import BaseTrainer
 from utils import inf_loop, MetricTracker
+from utils import transforms
 
 
 class Trainer(BaseTrainer):
@@ -26,6 +27,8 @@ class Trainer(BaseTrainer):
         self.do_validation = self.valid_data_loader is not None
         self.lr_scheduler = lr_scheduler
         self.log_step = int(np.sqrt(data_loader.batch_size))
+        # random rotation and resizing of whole batches on device (see pad_collate)
+        self.batch_augment = config['data_loader']['args'].get('batch_augment', False)
 
         self.train_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns], writer=self.writer)
         self.valid_metrics = MetricTracker('loss', *[m.__name__ for m in self.metric_ftns], writer=self.writer)
@@ -39,8 +42,11 @@ class Trainer(BaseTrainer):
         """
         self.model.train()
         self.train_metrics.reset()
-        for batch_idx, (data, target) in enumerate(self.data_loader):
+        for batch_idx, (data, target, *shapes) in enumerate(self.data_loader):
             data, target = data.to(self.device), target.to(self.device)
+            if self.batch_augment:
+                data, target, _ = transforms.random_rotate_and_resize_torch(data, target, shapes=shapes[0],
+                                                                            scale_range=0.5)
 
             self.optimizer.zero_grad()
             output, style = self.model(data)
@@ -95,8 +101,11 @@ class Trainer(BaseTrainer):
         self.model.eval()
         self.valid_metrics.reset()
         with torch.no_grad():
-            for batch_idx, (data, target) in enumerate(self.valid_data_loader):
+            for batch_idx, (data, target, *shapes) in enumerate(self.valid_data_loader):
                 data, target = data.to(self.device), target.to(self.device)
+                if self.batch_augment:
+                    data, target, _ = transforms.random_rotate_and_resize_torch(data, target, shapes=shapes[0],
+                                                                                scale_range=0.5)
 
                 output = self.model(data)
                 loss = self.criterion(output, target)
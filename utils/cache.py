@@ -0,0 +1,193 @@
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import torch
+
+class FlowCache:
+    """ persistent content-addressed cache of flows computed from masks
+
+    Flows are stored as float32 .npy files in cache_dir, named by a hash of the
+    mask array, and read back memory-mapped. The total size of the cache is kept
+    below max_bytes by deleting least recently used files (file modification
+    times are updated on every read). The size is tracked as a running total
+    of stored files; the cache directory is only scanned when the total exceeds
+    max_bytes (then least recently used files are deleted down to 90% of max_bytes)
+    and every scan_every puts (to count files written by other processes).
+
+    Parameters
+    --------------
+
+    cache_dir: str
+        directory where flows are stored (created if it does not exist)
+
+    max_bytes: int (optional, default 10 GB)
+        maximum total size of cached flows in bytes, None for no limit
+
+    version: str (optional, default 'v1')
+        included in every key, change it to invalidate previously cached flows
+
+    scan_every: int (optional, default 1000)
+        number of puts between scans of the cache directory for its total size
+
+    """
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3, version='v1', scan_every=1000):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self.version = version
+        self.scan_every = scan_every
+        self._total = None
+        self._nput = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, masks):
+        """ hash of mask values, shape and dtype """
+        masks = np.ascontiguousarray(masks)
+        h = hashlib.sha1(self.version.encode())
+        h.update(str((masks.shape, masks.dtype.str)).encode())
+        h.update(masks.data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, masks):
+        """ return cached flows for masks as read-only memory-mapped float32 array, or None """
+        filename = self.path(self.key(masks))
+        try:
+            flows = np.load(filename, mmap_mode='r')
+            os.utime(filename)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return flows
+
+    def put(self, masks, flows):
+        """ store flows for masks (written to a temporary file first so readers never see partial files) """
+        filename = self.path(self.key(masks))
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(flows, np.float32))
+                nbytes = f.tell()
+            try:
+                nbytes -= os.path.getsize(filename)
+            except OSError:
+                pass
+            os.replace(tmp, filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        if self.max_bytes is None:
+            return
+        if self._total is None or self._nput % self.scan_every == 0:
+            self._total = self.size()
+        else:
+            self._total += nbytes
+        self._nput += 1
+        if self._total > self.max_bytes:
+            self._total = self.evict(int(0.9 * self.max_bytes))
+
+    def evict(self, max_bytes):
+        """ delete least recently used flows until cache size is at most max_bytes, returns cache size """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(f[1] for f in files)
+        for _, size, filename in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+    def size(self):
+        """ total size of cached flows in bytes """
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+
+class BufferPool:
+    """ pool of reusable arrays keyed by shape and dtype
+
+    get returns the same array for the same shape and dtype on every call, so
+    an array must not be used anymore once another get asks for its shape and
+    dtype. At most max_buffers arrays are kept (least recently used are dropped).
+
+    Parameters
+    --------------
+
+    max_buffers: int (optional, default 4)
+        maximum number of arrays kept in the pool
+
+    """
+    def __init__(self, max_buffers=4):
+        self.max_buffers = max_buffers
+        self.buffers = OrderedDict()
+
+    def key(self, shape, dtype):
+        return tuple(int(n) for n in shape), str(dtype)
+
+    def alloc(self, shape, dtype):
+        """ new array of shape and dtype (contents undefined) """
+        return np.empty(shape, dtype)
+
+    def get(self, shape, dtype=np.float32):
+        """ array of shape and dtype from the pool (contents undefined) """
+        key = self.key(shape, dtype)
+        buf = self.buffers.pop(key, None)
+        if buf is None:
+            buf = self.alloc(key[0], dtype)
+        self.buffers[key] = buf
+        while len(self.buffers) > self.max_buffers:
+            self.buffers.popitem(last=False)
+        return buf
+
+    def clear(self):
+        self.buffers.clear()
+
+
+class TorchBufferPool(BufferPool):
+    """ pool of reusable torch tensors (on CPU) keyed by shape and numpy dtype
+
+    Same as BufferPool but get returns torch tensors, in pinned memory if pin_memory,
+    so that they can be copied to the GPU asynchronously. tensor.numpy() gives a 
+    numpy view of a tensor.
+
+    Parameters
+    --------------
+
+    max_buffers: int (optional, default 4)
+        maximum number of tensors kept in the pool
+
+    pin_memory: bool (optional, default None)
+        allocate tensors in pinned memory, True if None and CUDA is available
+
+    """
+    def __init__(self, max_buffers=4, pin_memory=None):
+        super().__init__(max_buffers=max_buffers)
+        if pin_memory is None:
+            pin_memory = torch.cuda.is_available()
+        self.pin_memory = pin_memory
+
+    def key(self, shape, dtype):
+        return tuple(int(n) for n in shape), np.dtype(dtype).str
+
+    def alloc(self, shape, dtype):
+        """ new tensor of shape and (numpy) dtype (contents undefined) """
+        dtype = torch.from_numpy(np.empty(0, dtype)).dtype
+        return torch.empty(shape, dtype=dtype, pin_memory=self.pin_memory)
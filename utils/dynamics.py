@@ -1,10 +1,13 @@
 import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from scipy.ndimage.filters import maximum_filter1d
 import scipy.ndimage
 import numpy as np
 import tifffile
-from numba import njit
-from . import metrics, utils
+from numba import njit, prange
+from . import metrics, utils, relabel
 
 # try:
 import torch
@@ -12,7 +15,7 @@ import torch
 TORCH_ENABLED = True
 torch_GPU = torch.device('cuda')
 
-@njit('(float64[:], int32[:], int32[:], int32, int32, int32, int32)', nogil=True)
+@njit('(float64[:], int32[:], int32[:], int32, int32, int32, int32)', nogil=True, cache=True)
 def _extend_centers(T,y,x,ymed,xmed,Lx, niter):
     """ run diffusion from center of mask (ymed, xmed) on mask pixels (y, x)
 
@@ -56,7 +59,7 @@ def _extend_centers(T,y,x,ymed,xmed,Lx, niter):
                                             T[(y+1)*Lx + x-1] + T[(y+1)*Lx + x+1])
     return T
 
-def labels_to_flows(labels, files=None):
+def labels_to_flows(labels, files=None, cache=None):
     """ convert labels (list of masks or flows) to flows for training models
 
     if files is not None, flows are saved to files to be reused
@@ -68,6 +71,14 @@ def labels_to_flows(labels, files=None):
         labels[k] can be 2D or 3D, if [3 x Ly x Lx] then it is assumed that flows were precomputed.
         Otherwise labels[k][0] or labels[k] (if 2D) is used to create flows and cell probabilities.
 
+    files: list of str (optional, default None)
+        flows[k] is saved to files[k] with suffix _flows.tif
+
+    cache: utils.cache.FlowCache (optional, default None)
+        if not None, flows are looked up in the cache by a hash of labels[k][0]
+        and only computed (and added to the cache) if missing; cached flows are 
+        returned as read-only memory-mapped arrays
+
     Returns
     --------------
 
@@ -82,11 +93,17 @@ def labels_to_flows(labels, files=None):
 
     if labels[0].shape[0] == 1 or labels[0].ndim < 3:
         # print('NOTE: computing flows for labels (could be done before to save time)')
-        # compute flows        
-        veci = [masks_to_flows(labels[n][0])[0] for n in range(nimg)]
-        # concatenate flows with cell probability
-        flows = [np.concatenate((labels[n][[0]], veci[n], labels[n][[0]]>0.5), axis=0).astype(np.float32)
-                    for n in range(nimg)]
+        flows = [None] * nimg
+        if cache is not None:
+            flows = [cache.get(labels[n][0]) for n in range(nimg)]
+        for n in range(nimg):
+            if flows[n] is None:
+                # compute flows and concatenate with cell probability
+                veci = masks_to_flows(labels[n][0])[0]
+                flows[n] = np.concatenate((labels[n][[0]], veci, labels[n][[0]]>0.5), 
+                                          axis=0).astype(np.float32)
+                if cache is not None:
+                    cache.put(labels[n][0], flows[n])
         if files is not None:
             for flow, file in zip(flows, files):
                 file_name = os.path.splitext(file)[0]
@@ -96,7 +113,315 @@ def labels_to_flows(labels, files=None):
         flows = [labels[n].astype(np.float32) for n in range(nimg)]
     return flows
 
-def masks_to_flows(masks):
+def _object_pixels(masks):
+    """ group the pixels of all objects in masks by label
+
+    Parameters
+    --------------
+
+    masks: int, ND-array
+        labelled masks 0=NO masks; 1,2,...=mask labels
+
+    Returns
+    --------------
+
+    pix: int32, 2D array
+        coordinates of object pixels [ndim x npixels], sorted by label and
+        in raster order within each label
+
+    offsets: int64, 1D array
+        pixels of label k are pix[:, offsets[k]:offsets[k+1]], size [nmask+2]
+
+    """
+    lbl = masks.ravel()
+    ipix = np.nonzero(lbl)[0]
+    ipix = ipix[np.argsort(lbl[ipix], kind='stable')]
+    counts = np.bincount(lbl[ipix], minlength=int(masks.max())+1)
+    offsets = np.zeros(len(counts)+1, np.int64)
+    offsets[2:] = np.cumsum(counts[1:])
+    pix = np.array(np.unravel_index(ipix, masks.shape)).astype(np.int32)
+    return pix, offsets
+
+@njit('float64(float64[:], int64[:], int64[:], float64[:,:])', nogil=True, cache=True)
+def _gradient_change(T, inds, strides, G):
+    """ change in normalized gradient of diffusion density since last call
+
+    Parameters
+    --------------
+
+    T: float64, array
+        flattened diffusion density of object bounding box
+
+    inds: int64, array
+        indices of object pixels in T
+
+    strides: int64, array
+        strides of each axis in T
+
+    G: float64, 2D array
+        normalized gradients from last call [npixels x ndim] (updated in place)
+
+    Returns
+    ---------------
+
+    dmean: float64
+        mean over pixels of the norm of the change in normalized gradient
+
+    """
+    ndim = strides.shape[0]
+    g = np.zeros(ndim, np.float64)
+    dsum = 0.
+    for j in range(inds.shape[0]):
+        norm = 0.
+        for d in range(ndim):
+            g[d] = T[inds[j]+strides[d]] - T[inds[j]-strides[d]]
+            norm += g[d]**2
+        norm = 1e-20 + norm**0.5
+        dj = 0.
+        for d in range(ndim):
+            g[d] /= norm
+            dj += (g[d] - G[j,d])**2
+            G[j,d] = g[d]
+        dsum += dj**0.5
+    return dsum / inds.shape[0]
+
+@njit('(int32[:], int32[:], int64[:], float64, int64, int64, float64[:,:,:], float64[:,:], float64, int64, int32[:])', 
+      nogil=True, cache=True)
+def _extend_centers_all(ypix, xpix, offsets, s2, i0, i1, mu, mu_c, tol, check_every, niters):
+    """ run diffusion and compute flows for objects i0 to i1 in one call
+
+    Same computation as the per-object loop over `_extend_centers` in 
+    `masks_to_flows`, with the centers, diffusion and gradients of every 
+    object computed in compiled code. Results are written into mu and mu_c.
+
+    Parameters
+    --------------
+
+    ypix: int32, array
+        y-coordinates of object pixels (from `_object_pixels`)
+
+    xpix: int32, array
+        x-coordinates of object pixels (from `_object_pixels`)
+
+    offsets: int64, array
+        offsets of each object in ypix and xpix (from `_object_pixels`)
+
+    s2: float64
+        squared width of gaussian for mu_c
+
+    i0: int64
+        first mask label to process
+
+    i1: int64
+        process mask labels up to i1 (exclusive)
+
+    mu: float64, 3D array
+        unnormalized flows [2 x Ly x Lx] (updated in place)
+
+    mu_c: float64, 2D array
+        distance of each pixel to center of its mask (updated in place)
+
+    tol: float64
+        if tol > 0, stop diffusion of an object once its normalized gradient 
+        field changes by less than tol over check_every iterations 
+        (see `_gradient_change`); otherwise run 2*(ptp(x)+ptp(y)) iterations
+
+    check_every: int64
+        number of iterations between convergence checks
+
+    niters: int32, array
+        number of iterations run for each mask label (updated in place)
+
+    """
+    for k in range(i0, i1):
+        start = offsets[k]
+        n = offsets[k+1] - start
+        if n == 0:
+            continue
+        yg = ypix[start : start+n]
+        xg = xpix[start : start+n]
+        y0, x0 = yg.min(), xg.min()
+        y = yg - y0 + 1
+        x = xg - x0 + 1
+        lx = xg.max() - x0 + 2
+        ly = yg.max() - y0 + 2
+
+        # center is pixel closest to median
+        ymed = np.median(y)
+        xmed = np.median(x)
+        imin = np.argmin((x-xmed)**2 + (y-ymed)**2)
+        xc = x[imin]
+        yc = y[imin]
+        for j in range(n):
+            d2 = (x[j]-xc)**2 + (y[j]-yc)**2
+            mu_c[yg[j], xg[j]] = np.exp(-d2/s2)
+
+        # diffusion from center
+        niter = 2*((x.max() - x.min()) + (y.max() - y.min()))
+        T = np.zeros((ly+2)*(lx+2), np.float64)
+        Tj = np.zeros(n, np.float64)
+        inds = y.astype(np.int64)*lx + x
+        strides = np.array([lx, 1], np.int64)
+        G = np.zeros((n, 2), np.float64)
+        for t in range(niter):
+            T[yc*lx + xc] += 1
+            for j in range(n):
+                i = inds[j]
+                Tj[j] = 1/9. * (T[i] + T[i-lx] + T[i+lx] +
+                                T[i-1] + T[i+1] +
+                                T[i-lx-1] + T[i-lx+1] +
+                                T[i+lx-1] + T[i+lx+1])
+            for j in range(n):
+                T[inds[j]] = Tj[j]
+            if tol > 0 and (t+1) % check_every == 0:
+                if _gradient_change(T, inds, strides, G) < tol and t+1 > check_every:
+                    niter = t+1
+                    break
+        niters[k] = niter
+        for j in range(n):
+            i = (y[j]+1)*lx + x[j]+1
+            T[i] = np.log(1.+T[i])
+
+        # gradients of diffusion density
+        for j in range(n):
+            i = y[j]*lx + x[j]
+            mu[0, yg[j], xg[j]] = T[i+lx] - T[i-lx]
+            mu[1, yg[j], xg[j]] = T[i+1] - T[i-1]
+
+def _run_labels(func, offsets, n_workers=1):
+    """ run func(i0, i1) over all mask labels, optionally on several threads
+
+    Labels are split into batches with similar numbers of pixels so that 
+    compiled kernels (which release the GIL) can run on a thread pool.
+
+    Parameters
+    --------------
+
+    func: function
+        func(i0, i1) processes mask labels i0 to i1 (exclusive)
+
+    offsets: int64, array
+        offsets of each label in the pixel arrays (from `_object_pixels`)
+
+    n_workers: int (optional, default 1)
+        number of threads
+
+    """
+    nlabels = len(offsets) - 1
+    if n_workers > 1:
+        nbatch = 4 * n_workers
+        ibatch = np.searchsorted(offsets, np.linspace(0, offsets[-1], nbatch+1)[1:-1])
+        ibatch = np.unique(np.concatenate(([1], np.clip(ibatch, 1, nlabels), [nlabels])))
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            jobs = [pool.submit(func, i0, i1) for i0, i1 in zip(ibatch[:-1], ibatch[1:])]
+            for job in jobs:
+                job.result()
+    else:
+        func(1, nlabels)
+
+@njit('(int32[:], int32[:], int32[:], int64[:], int64, int64, float32[:,:,:,:], float64, int64, int32[:])', 
+      nogil=True, cache=True)
+def _extend_centers3D(zpix, ypix, xpix, offsets, i0, i1, mu, tol, check_every, niters):
+    """ run 3D diffusion and compute flows for objects i0 to i1
+
+    Diffusion is run once per object in its 3D bounding box with a 
+    27-point (26 neighbours + center) averaging stencil, instead of 
+    summing 2D flows from every z, y and x plane.
+
+    Parameters
+    --------------
+
+    zpix: int32, array
+        z-coordinates of object pixels (from `_object_pixels`)
+
+    ypix: int32, array
+        y-coordinates of object pixels (from `_object_pixels`)
+
+    xpix: int32, array
+        x-coordinates of object pixels (from `_object_pixels`)
+
+    offsets: int64, array
+        offsets of each object in pixel arrays (from `_object_pixels`)
+
+    i0: int64
+        first mask label to process
+
+    i1: int64
+        process mask labels up to i1 (exclusive)
+
+    mu: float32, 4D array
+        unnormalized flows [3 x Lz x Ly x Lx] (updated in place)
+
+    tol: float64
+        if tol > 0, stop diffusion of an object once its normalized gradient 
+        field changes by less than tol over check_every iterations
+
+    check_every: int64
+        number of iterations between convergence checks
+
+    niters: int32, array
+        number of iterations run for each mask label (updated in place)
+
+    """
+    for k in range(i0, i1):
+        start = offsets[k]
+        n = offsets[k+1] - start
+        if n == 0:
+            continue
+        zg = zpix[start : start+n]
+        yg = ypix[start : start+n]
+        xg = xpix[start : start+n]
+        z0, y0, x0 = zg.min(), yg.min(), xg.min()
+        z = zg - z0 + 1
+        y = yg - y0 + 1
+        x = xg - x0 + 1
+        # strides of padded bounding box
+        sx = 1
+        sy = xg.max() - x0 + 3
+        sz = sy * (yg.max() - y0 + 3)
+        nT = sz * (zg.max() - z0 + 3)
+
+        # center is pixel closest to median
+        zmed = np.median(z)
+        ymed = np.median(y)
+        xmed = np.median(x)
+        imin = np.argmin((z-zmed)**2 + (y-ymed)**2 + (x-xmed)**2)
+        ic = z[imin]*sz + y[imin]*sy + x[imin]*sx
+
+        niter = 2*((z.max() - z.min()) + (y.max() - y.min()) + (x.max() - x.min()))
+        T = np.zeros(nT, np.float64)
+        Tx = np.zeros(nT, np.float64)
+        Txy = np.zeros(nT, np.float64)
+        inds = z*sz + y*sy + x*sx
+        strides = np.array([sz, sy, sx], np.int64)
+        G = np.zeros((n, 3), np.float64)
+        for t in range(niter):
+            T[ic] += 1
+            # 27-point box average as three separable 3-point sums
+            for i in range(1, nT-1):
+                Tx[i] = T[i-sx] + T[i] + T[i+sx]
+            for i in range(sy, nT-sy):
+                Txy[i] = Tx[i-sy] + Tx[i] + Tx[i+sy]
+            for j in range(n):
+                i = inds[j]
+                T[i] = (Txy[i-sz] + Txy[i] + Txy[i+sz]) / 27.
+            if tol > 0 and (t+1) % check_every == 0:
+                if _gradient_change(T, inds, strides, G) < tol and t+1 > check_every:
+                    niter = t+1
+                    break
+        niters[k] = niter
+        for j in range(n):
+            T[inds[j]] = np.log(1.+T[inds[j]])
+
+        # gradients of diffusion density
+        for j in range(n):
+            i = inds[j]
+            mu[0, zg[j], yg[j], xg[j]] = T[i+sz] - T[i-sz]
+            mu[1, zg[j], yg[j], xg[j]] = T[i+sy] - T[i-sy]
+            mu[2, zg[j], yg[j], xg[j]] = T[i+sx] - T[i-sx]
+
+def masks_to_flows(masks, fused=True, n_workers=1, native3D=False, tol=None, check_every=10,
+                   return_niter=False):
     """ convert masks to flows using diffusion from center pixel
 
     Center of masks where diffusion starts is defined to be the 
@@ -110,6 +435,29 @@ def masks_to_flows(masks):
     masks: int, 2D or 3D array
         labelled masks 0=NO masks; 1,2,...=mask labels
 
+    fused: bool (optional, default True)
+        compute all objects in a single compiled call (`_extend_centers_all`)
+        instead of looping over objects in python (same output)
+
+    n_workers: int (optional, default 1)
+        number of threads running `_extend_centers_all` on batches of objects
+        (only used if fused); results are written into shared mu and mu_c
+
+    native3D: bool (optional, default False)
+        if masks are 3D, run 3D diffusion once per object (`_extend_centers3D`)
+        instead of summing 2D flows computed on every z, y and x plane
+
+    tol: float (optional, default None)
+        if not None, stop the diffusion of each object once the normalized gradient 
+        field changes by less than tol (mean over pixels) between two checks, 
+        instead of always running 2*(ptp(x)+ptp(y)) iterations (only used if fused)
+
+    check_every: int (optional, default 10)
+        number of diffusion iterations between convergence checks if tol is not None
+
+    return_niter: bool (optional, default False)
+        also return the number of diffusion iterations run for each mask
+
     Returns
     -------------
 
@@ -121,29 +469,58 @@ def masks_to_flows(masks):
         for each pixel, the distance to the center of the mask 
         in which it resides 
 
+    niters: int32, 1D array
+        number of diffusion iterations run for each mask label, 
+        niters[k] for mask k (only returned if return_niter, 
+        None if not fused or if 3D masks are not native3D)
+
     """
-    if masks.ndim > 2:
+    tol = 0. if tol is None else float(tol)
+    check_every = max(1, int(check_every))
+    niters = None
+    if masks.ndim > 2 and native3D:
+        mu = np.zeros((3,) + masks.shape, np.float32)
+        pix, offsets = _object_pixels(masks)
+        niters = np.zeros(len(offsets)-1, np.int32)
+        _run_labels(lambda i0, i1: _extend_centers3D(pix[0], pix[1], pix[2], offsets, 
+                                                     i0, i1, mu, tol, check_every, niters),
+                    offsets, n_workers=n_workers)
+        mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
+        return (mu, None, niters) if return_niter else (mu, None)
+    elif masks.ndim > 2:
         Lz, Ly, Lx = masks.shape
         mu = np.zeros((3, Lz, Ly, Lx), np.float32)
         for z in range(Lz):
-            mu0 = masks_to_flows(masks[z])[0]
+            mu0 = masks_to_flows(masks[z], fused=fused, n_workers=n_workers, 
+                                 tol=tol, check_every=check_every)[0]
             mu[[1,2], z] += mu0
         for y in range(Ly):
-            mu0 = masks_to_flows(masks[:,y])[0]
+            mu0 = masks_to_flows(masks[:,y], fused=fused, n_workers=n_workers, 
+                                 tol=tol, check_every=check_every)[0]
             mu[[0,2], :, y] += mu0
         for x in range(Lx):
-            mu0 = masks_to_flows(masks[:,:,x])[0]
+            mu0 = masks_to_flows(masks[:,:,x], fused=fused, n_workers=n_workers, 
+                                 tol=tol, check_every=check_every)[0]
             mu[[0,1], :, :, x] += mu0
-        return mu, None
+        return (mu, None, niters) if return_niter else (mu, None)
 
     Ly, Lx = masks.shape
     mu = np.zeros((2, Ly, Lx), np.float64)
     mu_c = np.zeros((Ly, Lx), np.float64)
     
-    nmask = masks.max()
-    slices = scipy.ndimage.find_objects(masks)
     dia = utils.diameters(masks)[0]
     s2 = (.15 * dia)**2
+    if fused:
+        pix, offsets = _object_pixels(masks)
+        niters = np.zeros(len(offsets)-1, np.int32)
+        _run_labels(lambda i0, i1: _extend_centers_all(pix[0], pix[1], offsets, s2, 
+                                                       i0, i1, mu, mu_c, 
+                                                       tol, check_every, niters),
+                    offsets, n_workers=n_workers)
+        mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
+        return (mu, mu_c, niters) if return_niter else (mu, mu_c)
+
+    slices = scipy.ndimage.find_objects(masks)
     for i,si in enumerate(slices):
         if si is not None:
             sr,sc = si
@@ -171,7 +548,7 @@ def masks_to_flows(masks):
 
     mu /= (1e-20 + (mu**2).sum(axis=0)**0.5)
 
-    return mu, mu_c
+    return (mu, mu_c, niters) if return_niter else (mu, mu_c)
 
 @njit(['(int16[:,:,:],float32[:], float32[:], float32[:,:])', 
         '(float32[:,:,:],float32[:], float32[:], float32[:,:])'], cache=True)
@@ -207,36 +584,326 @@ def map_coordinates(I, yc, xc, Y):
                       np.float32(I[c, yf1, xf]) * y * (1 - x) +
                       np.float32(I[c, yf1, xf1]) * y * x )
 
-def steps2D_interp(p, dP, niter, use_gpu=False):
+@njit(['int32(float32[:,:], int16[:,:,:], int32, float64, int32)', 
+       'int32(float32[:,:], float32[:,:,:], int32, float64, int32)'], nogil=True, parallel=True, cache=True)
+def _steps2D_interp(p, dP, niter, tol, check_every):
+    """ run interpolated dynamics of pixels in 2D in one compiled call
+
+    Bilinear sampling of dP (as in `map_coordinates`), Euler step and 
+    clamping to the image for all iterations, in parallel over blocks 
+    of pixels and without allocating arrays per iteration. Arithmetic
+    follows `map_coordinates` so results match the python loop exactly.
+
+    If tol > 0, every check_every steps the pixels that moved less than 
+    tol since the last check are removed from the working set of their block.
+
+    Parameters
+    ----------------
+
+    p: float32, 2D array
+        pixel locations [axis x npixels] (updated in place)
+
+    dP: int16 or float32, 3D array
+        flows [axis x Ly x Lx]
+
+    niter: int32
+        maximum number of iterations of dynamics to run
+
+    tol: float64
+        distance in pixels below which pixels are considered converged 
+        (0 to always run niter iterations)
+
+    check_every: int32
+        number of iterations between convergence checks
+
+    Returns
+    ---------------
+
+    nsteps: int32
+        number of iterations run until all pixels converged (at most niter)
+
+    """
+    Ly, Lx = dP.shape[1:]
+    npix = p.shape[1]
+    # blocks of pixels so that independent pixels are interleaved in each step
+    bsize = 256
+    nblocks = (npix + bsize - 1) // bsize
+    nsteps = np.zeros(nblocks + 1, np.int32)
+    for b in prange(nblocks):
+        j0 = b*bsize
+        active = np.arange(j0, min(npix, j0+bsize))
+        nactive = active.shape[0]
+        anchor = p[:, j0 : j0+nactive].copy()
+        t = 0
+        while t < niter and nactive > 0:
+            for a in range(nactive):
+                j = active[a]
+                py = p[0,j]
+                px = p[1,j]
+                yf = np.int32(py)
+                xf = np.int32(px)
+                y = np.float32(py - yf)
+                x = np.float32(px - xf)
+                yf = min(Ly-1, max(0, yf))
+                xf = min(Lx-1, max(0, xf))
+                yf1 = min(Ly-1, yf+1)
+                xf1 = min(Lx-1, xf+1)
+                dy = np.float32(np.float32(dP[0, yf, xf]) * (1 - y) * (1 - x) +
+                                np.float32(dP[0, yf, xf1]) * (1 - y) * x +
+                                np.float32(dP[0, yf1, xf]) * y * (1 - x) +
+                                np.float32(dP[0, yf1, xf1]) * y * x)
+                dx = np.float32(np.float32(dP[1, yf, xf]) * (1 - y) * (1 - x) +
+                                np.float32(dP[1, yf, xf1]) * (1 - y) * x +
+                                np.float32(dP[1, yf1, xf]) * y * (1 - x) +
+                                np.float32(dP[1, yf1, xf1]) * y * x)
+                p[0,j] = min(Ly-1, max(0, py - dy))
+                p[1,j] = min(Lx-1, max(0, px - dx))
+            t += 1
+            if tol > 0 and t % check_every == 0:
+                # keep pixels that moved since last check
+                n = 0
+                for a in range(nactive):
+                    j = active[a]
+                    d2 = (p[0,j] - anchor[0,j-j0])**2 + (p[1,j] - anchor[1,j-j0])**2
+                    if d2 >= tol**2:
+                        anchor[0,j-j0] = p[0,j]
+                        anchor[1,j-j0] = p[1,j]
+                        active[n] = j
+                        n += 1
+                nactive = n
+        nsteps[b] = t
+    return nsteps.max()
+
+def steps2D_torch(p, dP, niter, device, dtype=None, tol=None, check_every=10):
+    """ run interpolated dynamics of pixels in 2D with torch for a batch of images
+
+    Flows are sampled with `torch.nn.functional.grid_sample` (bilinear, 
+    align_corners=True, same as `map_coordinates`) on any torch device,
+    e.g. 'cpu' (using intra-op threads) or 'cuda'.
+
+    Parameters
+    ----------------
+
+    p: float32, 3D array
+        pixel locations [nimg x axis x npixels]
+
+    dP: float32, 4D array
+        flows [nimg x axis x Ly x Lx]
+
+    niter: int
+        number of iterations of dynamics to run
+
+    device: torch device or str
+        device to run dynamics on
+
+    dtype: torch dtype (optional, default None)
+        dtype of pixel locations and flows on device, torch.float32 if None
+
+    tol: float (optional, default None)
+        if not None, stop once all pixels moved less than tol pixels 
+        in check_every iterations
+
+    check_every: int (optional, default 10)
+        number of iterations between convergence checks if tol is not None
+
+    Returns
+    ---------------
+
+    p: float32, 3D array
+        final locations of each pixel after dynamics [nimg x axis x npixels]
+
+    nsteps: int
+        number of iterations run
+
+    """
+    dtype = torch.float32 if dtype is None else dtype
+    device = torch.device(device)
+    Ly, Lx = dP.shape[-2:]
+    # grid_sample uses (x, y) coordinates between -1 and 1
+    scale = torch.tensor([(Lx-1)/2., (Ly-1)/2.], dtype=dtype, device=device)
+    with torch.no_grad():
+        pt = torch.as_tensor(np.ascontiguousarray(p[:, ::-1])).to(device=device, dtype=dtype)
+        pt = (pt.permute(0, 2, 1) / scale - 1).unsqueeze(1)
+        im = torch.as_tensor(np.ascontiguousarray(dP[:, ::-1])).to(device=device, dtype=dtype)
+        im /= scale[:, None, None]
+        if tol is not None:
+            tol = float(tol)
+            pt0 = pt.clone()
+        nsteps = 0
+        for t in range(niter):
+            dPt = torch.nn.functional.grid_sample(im, pt, align_corners=True)
+            pt.sub_(dPt.permute(0, 2, 3, 1)).clamp_(-1., 1.)
+            nsteps += 1
+            if tol is not None and nsteps % check_every == 0:
+                # distances in pixels, x and y are scaled differently for non-square images
+                if (((pt - pt0) * scale)**2).sum(dim=-1).max() < tol**2:
+                    break
+                pt0.copy_(pt)
+        pt = (pt[:, 0] + 1) * scale
+        p = pt.permute(0, 2, 1).flip(1).cpu().numpy().astype(np.float32)
+    return p, nsteps
+
+def steps2D_interp(p, dP, niter, use_gpu=False, fused=True, tol=None, check_every=10, 
+                   return_niter=False, device=None, dtype=None):
+    """ run interpolated dynamics of pixels in 2D
+
+    Parameters
+    ----------------
+
+    p: float32, 2D array
+        pixel locations [axis x npixels]
+
+    dP: float32, 3D array
+        flows [axis x Ly x Lx]
+
+    niter: int
+        number of iterations of dynamics to run
+
+    use_gpu: bool (optional, default False)
+        run dynamics with torch on the GPU (same as device=torch_GPU)
+
+    fused: bool (optional, default True)
+        on CPU, run all iterations in one compiled call (`_steps2D_interp`) 
+        instead of a python loop over `map_coordinates`
+
+    tol: float (optional, default None)
+        if not None, pixels that move less than tol pixels in check_every 
+        iterations stop moving, and dynamics end once all pixels stopped
+        (with torch, dynamics stop once all pixels moved less than tol)
+
+    check_every: int (optional, default 10)
+        number of iterations between convergence checks if tol is not None
+
+    return_niter: bool (optional, default False)
+        also return the number of iterations run
+
+    device: torch device or str (optional, default None)
+        if not None, run dynamics with torch on this device (see `steps2D_torch`)
+
+    dtype: torch dtype (optional, default None)
+        dtype of torch dynamics, torch.float32 if None
+
+    Returns
+    ---------------
+
+    p: float32, 2D array
+        final locations of each pixel after dynamics
+
+    nsteps: int
+        number of iterations run (only returned if return_niter)
+
+    """
     shape = dP.shape[1:]
-    if use_gpu and TORCH_ENABLED:
+    if device is None and use_gpu and TORCH_ENABLED:
         device = torch_GPU
-        pt = torch.from_numpy(p[[1,0]].T).double().to(device)
-        pt = pt.unsqueeze(0).unsqueeze(0)
-        pt[:,:,:,0] = (pt[:,:,:,0]/(shape[1]-1)) # normalize to between  0 and 1
-        pt[:,:,:,1] = (pt[:,:,:,1]/(shape[0]-1)) # normalize to between  0 and 1
-        pt = pt*2-1                       # normalize to between -1 and 1
-        im = torch.from_numpy(dP[[1,0]]).double().to(device)
-        im = im.unsqueeze(0)
-        for k in range(2):
-            im[:,k,:,:] /= (shape[1-k]-1) / 2.
-        for t in range(niter):
-            dPt = torch.nn.functional.grid_sample(im, pt)
-            for k in range(2):
-                pt[:,:,:,k] = torch.clamp(pt[:,:,:,k] - dPt[:,k,:,:], -1., 1.)
-        pt = (pt+1)*0.5
-        pt[:,:,:,0] = pt[:,:,:,0] * (shape[1]-1)
-        pt[:,:,:,1] = pt[:,:,:,1] * (shape[0]-1)
-        return pt[:,:,:,[1,0]].cpu().numpy().squeeze().T
+    if device is not None:
+        p, niter = steps2D_torch(p[np.newaxis], dP[np.newaxis], niter, device, dtype=dtype,
+                                 tol=tol, check_every=check_every)
+        p = p[0]
+    elif fused:
+        tol = 0. if tol is None else float(tol)
+        niter = _steps2D_interp(p, dP, np.int32(niter), tol, np.int32(max(1, check_every)))
     else:
         dPt = np.zeros(p.shape, np.float32)
         for t in range(niter):
             map_coordinates(dP, p[0], p[1], dPt)
             p[0] = np.minimum(shape[0]-1, np.maximum(0, p[0] - dPt[0]))
             p[1] = np.minimum(shape[1]-1, np.maximum(0, p[1] - dPt[1]))
-        return p
+    return (p, int(niter)) if return_niter else p
 
-@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True)
+@njit('int32(float32[:,:], float32[:,:,:,:], int32, float64, int32)', 
+      nogil=True, parallel=True, cache=True)
+def _steps3D_interp(p, dP, niter, tol, check_every):
+    """ run interpolated dynamics of pixels in 3D in one compiled call
+
+    Trilinear sampling of dP, Euler step and clamping to the volume for 
+    all iterations, in parallel over blocks of pixels. If tol > 0, every 
+    check_every steps the pixels that moved less than tol since the last 
+    check are removed from the working set of their block.
+
+    Parameters
+    ----------------
+
+    p: float32, 2D array
+        pixel locations [axis x npixels] (updated in place)
+
+    dP: float32, 4D array
+        flows [axis x Lz x Ly x Lx]
+
+    niter: int32
+        maximum number of iterations of dynamics to run
+
+    tol: float64
+        distance in pixels below which pixels are considered converged 
+        (0 to always run niter iterations)
+
+    check_every: int32
+        number of iterations between convergence checks
+
+    Returns
+    ---------------
+
+    nsteps: int32
+        number of iterations run until all pixels converged (at most niter)
+
+    """
+    Lz, Ly, Lx = dP.shape[1:]
+    npix = p.shape[1]
+    bsize = 256
+    nblocks = (npix + bsize - 1) // bsize
+    nsteps = np.zeros(nblocks + 1, np.int32)
+    for b in prange(nblocks):
+        j0 = b*bsize
+        active = np.arange(j0, min(npix, j0+bsize))
+        nactive = active.shape[0]
+        anchor = p[:, j0 : j0+nactive].copy()
+        dp = np.zeros(3, np.float32)
+        t = 0
+        while t < niter and nactive > 0:
+            for a in range(nactive):
+                j = active[a]
+                pz = p[0,j]
+                py = p[1,j]
+                px = p[2,j]
+                zf = np.int32(pz)
+                yf = np.int32(py)
+                xf = np.int32(px)
+                z = np.float32(pz - zf)
+                y = np.float32(py - yf)
+                x = np.float32(px - xf)
+                zf = min(Lz-1, max(0, zf))
+                yf = min(Ly-1, max(0, yf))
+                xf = min(Lx-1, max(0, xf))
+                zf1 = min(Lz-1, zf+1)
+                yf1 = min(Ly-1, yf+1)
+                xf1 = min(Lx-1, xf+1)
+                for c in range(3):
+                    dp[c] = ((dP[c, zf, yf, xf] * (1 - x) + dP[c, zf, yf, xf1] * x) * (1 - y) * (1 - z) +
+                             (dP[c, zf, yf1, xf] * (1 - x) + dP[c, zf, yf1, xf1] * x) * y * (1 - z) +
+                             (dP[c, zf1, yf, xf] * (1 - x) + dP[c, zf1, yf, xf1] * x) * (1 - y) * z +
+                             (dP[c, zf1, yf1, xf] * (1 - x) + dP[c, zf1, yf1, xf1] * x) * y * z)
+                p[0,j] = min(Lz-1, max(0, pz - dp[0]))
+                p[1,j] = min(Ly-1, max(0, py - dp[1]))
+                p[2,j] = min(Lx-1, max(0, px - dp[2]))
+            t += 1
+            if tol > 0 and t % check_every == 0:
+                # keep pixels that moved since last check
+                n = 0
+                for a in range(nactive):
+                    j = active[a]
+                    d2 = ((p[0,j] - anchor[0,j-j0])**2 + (p[1,j] - anchor[1,j-j0])**2 + 
+                          (p[2,j] - anchor[2,j-j0])**2)
+                    if d2 >= tol**2:
+                        anchor[0,j-j0] = p[0,j]
+                        anchor[1,j-j0] = p[1,j]
+                        anchor[2,j-j0] = p[2,j]
+                        active[n] = j
+                        n += 1
+                nactive = n
+        nsteps[b] = t
+    return nsteps.max()
+
+@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True, cache=True)
 def steps3D(p, dP, inds, niter):
     """ run dynamics of pixels to recover masks in 3D
     
@@ -277,7 +944,7 @@ def steps3D(p, dP, inds, niter):
             p[2,z,y,x] = min(shape[2]-1, max(0, p[2,z,y,x] - dP[2,p0,p1,p2]))
     return p
 
-@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32)', nogil=True)
+@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32)', nogil=True, cache=True)
 def steps2D(p, dP, inds, niter):
     """ run dynamics of pixels to recover masks in 2D
     
@@ -316,7 +983,8 @@ def steps2D(p, dP, inds, niter):
             p[1,y,x] = min(shape[1]-1, max(0, p[1,y,x] - dP[1,p0,p1]))
     return p
 
-def follow_flows(dP, niter=200, interp=True, use_gpu=False):
+def follow_flows(dP, niter=200, interp=None, use_gpu=False, tol=None, check_every=10, 
+                 return_niter=False, device=None, dtype=None):
     """ define pixels and run dynamics to recover masks in 2D
     
     Pixels are meshgrid. Only pixels with non-zero cell-probability
@@ -325,29 +993,68 @@ def follow_flows(dP, niter=200, interp=True, use_gpu=False):
     Parameters
     ----------------
 
-    dP: float32, 3D or 4D array
-        flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
+    dP: float32, 3D or 4D array, or list of 3D arrays
+        flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]; a list of 2D flows
+        [axis x Ly x Lx] of the same size is run as a batch
 
     niter: int (optional, default 200)
         number of iterations of dynamics to run
 
-    interp: bool (optional, default True)
-        interpolate during 2D dynamics (not available in 3D) 
+    interp: bool (optional, default None)
+        interpolate during dynamics (bilinear in 2D, trilinear in 3D). 
+        If None, True in 2D and False in 3D (nearest-voxel `steps3D`)
         (in previous versions + paper it was False)
 
     use_gpu: bool (optional, default False)
         use GPU to run interpolated dynamics (faster than CPU)
 
+    tol: float (optional, default None)
+        if not None, pixels that move less than tol pixels in check_every 
+        iterations are removed from the set of moving pixels, and dynamics 
+        stop once no pixels are left (interpolated dynamics)
+
+    check_every: int (optional, default 10)
+        number of iterations between convergence checks if tol is not None
+
+    return_niter: bool (optional, default False)
+        also return the number of iterations run
+
+    device: torch device or str (optional, default None)
+        if not None, run interpolated 2D dynamics with torch on this device 
+        ('cpu', 'cuda', ...), with all images of a batch in one call
+
+    dtype: torch dtype (optional, default None)
+        dtype of torch dynamics, torch.float32 if None
 
     Returns
     ---------------
 
-    p: float32, 3D array
+    p: float32, 3D array (or list of 3D arrays if dP is a list)
         final locations of each pixel after dynamics
 
+    nsteps: int
+        number of iterations run (only returned if return_niter)
+
     """
+    if device is None and use_gpu and TORCH_ENABLED:
+        device = torch_GPU
+    if isinstance(dP, (list, tuple)):
+        interp = True if interp is None else interp
+        if device is None or not interp:
+            out = [follow_flows(dPi, niter=niter, interp=interp, tol=tol, check_every=check_every,
+                                return_niter=True) for dPi in dP]
+            p = [o[0] for o in out]
+            niter = max([o[1] for o in out]) if len(out) > 0 else 0
+        else:
+            p, niter = _follow_flows_torch(np.stack(dP), niter, device, dtype=dtype, 
+                                           tol=tol, check_every=check_every)
+            p = list(p)
+        return (p, int(niter)) if return_niter else p
+
     shape = np.array(dP.shape[1:]).astype(np.int32)
     niter = np.int32(niter)
+    if interp is None:
+        interp = len(shape) < 3
     if len(shape)>2:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]),
                 np.arange(shape[2]), indexing='ij')
@@ -355,7 +1062,17 @@ def follow_flows(dP, niter=200, interp=True, use_gpu=False):
         # run dynamics on subset of pixels
         #inds = np.array(np.nonzero(dP[0]!=0)).astype(np.int32).T
         inds = np.array(np.nonzero(np.abs(dP[0])>1e-3)).astype(np.int32).T
-        p = steps3D(p, dP, inds, niter)
+        if not interp:
+            p = steps3D(p, dP, inds, niter)
+        else:
+            pi = p[:, inds[:,0], inds[:,1], inds[:,2]]
+            niter = _steps3D_interp(pi, dP.astype(np.float32), niter, 
+                                    0. if tol is None else float(tol), np.int32(max(1, check_every)))
+            p[:, inds[:,0], inds[:,1], inds[:,2]] = pi
+    elif interp and device is not None:
+        p, niter = _follow_flows_torch(dP[np.newaxis], niter, device, dtype=dtype, 
+                                       tol=tol, check_every=check_every)
+        p = p[0]
     else:
         p = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
         p = np.array(p).astype(np.float32)
@@ -364,9 +1081,35 @@ def follow_flows(dP, niter=200, interp=True, use_gpu=False):
         if not interp:
             p = steps2D(p, dP, inds, niter)
         else:
-            p[:,inds[:,0],inds[:,1]] = steps2D_interp(p[:,inds[:,0], inds[:,1]], 
-                                                      dP, niter, use_gpu=use_gpu)
-    return p
+            p[:,inds[:,0],inds[:,1]], niter = steps2D_interp(p[:,inds[:,0], inds[:,1]], 
+                                                             dP, niter, tol=tol, 
+                                                             check_every=check_every,
+                                                             return_niter=True)
+    return (p, int(niter)) if return_niter else p
+
+def _follow_flows_torch(dP, niter, device, dtype=None, tol=None, check_every=10):
+    """ run interpolated dynamics on a batch of 2D flows [nimg x axis x Ly x Lx] with torch
+    
+    Pixels of each image (with non-zero flows) are padded to the same 
+    number so that all images run in one call of `steps2D_torch`. 
+    Returns pixel locations [nimg x axis x Ly x Lx] and number of iterations run.
+    """
+    nimg, _, Ly, Lx = dP.shape
+    p = np.meshgrid(np.arange(Ly), np.arange(Lx), indexing='ij')
+    p = np.tile(np.array(p).astype(np.float32), (nimg, 1, 1, 1))
+    inds = [np.nonzero(np.abs(dP[n,0])>1e-3) for n in range(nimg)]
+    npix = np.array([len(ind[0]) for ind in inds])
+    if npix.max() == 0:
+        return p, 0
+    # pad pixels of each image to the same number (padding is discarded)
+    pb = np.zeros((nimg, 2, npix.max()), np.float32)
+    for n in range(nimg):
+        pb[n, :, :npix[n]] = p[n][:, inds[n][0], inds[n][1]]
+    pb, nsteps = steps2D_torch(pb, dP.astype(np.float32), niter, device, dtype=dtype,
+                               tol=tol, check_every=check_every)
+    for n in range(nimg):
+        p[n][:, inds[n][0], inds[n][1]] = pb[n, :, :npix[n]]
+    return p, nsteps
 
 def remove_bad_flow_masks(masks, flows, threshold=0.4):
     """ remove masks which have inconsistent flows 
@@ -399,10 +1142,280 @@ def remove_bad_flow_masks(masks, flows, threshold=0.4):
     """
     merrors, _ = metrics.flow_error(masks, flows)
     badi = 1+(merrors>threshold).nonzero()[0]
-    masks[np.isin(masks, badi)] = 0
-    return masks
+    return relabel.remove_labels(masks, badi, out=masks)
+
+@njit('(boolean[:], int64[:], int64[:], int32, int32[:])', nogil=True, cache=True)
+def _grow_seeds(good, shape, seeds, niter, M):
+    """ grow all seeds by niter steps into pixels where good is True
+
+    Equivalent to expanding each seed niter times by its 3x3 (or 3x3x3) 
+    neighbourhood and keeping pixels where good is True, with later seeds 
+    overwriting earlier ones, as in the python loop of `get_masks`.
+
+    Parameters
+    ----------------
+
+    good: bool, 1D array
+        flattened ND array of pixels that masks can grow into
+
+    shape: int64, 1D array
+        shape of the ND array
+
+    seeds: int64, 1D array
+        flattened indices of seeds
 
-def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
+    niter: int32
+        number of expansion steps
+
+    M: int32, 1D array
+        flattened ND array of masks, pixels of seed k are set to k+1 (updated in place)
+
+    """
+    ndim = shape.shape[0]
+    strides = np.ones(ndim, np.int64)
+    for d in range(ndim-2, -1, -1):
+        strides[d] = strides[d+1] * shape[d+1]
+    nexpand = 3**ndim
+    expand = np.zeros((nexpand, ndim), np.int64)
+    for e in range(nexpand):
+        r = e
+        for d in range(ndim-1, -1, -1):
+            expand[e, d] = r % 3 - 1
+            r //= 3
+    # breadth-first search from each seed, visited pixels are stamped with seed index
+    stamp = np.full(M.shape[0], -1, np.int64)
+    queue = np.zeros((2*niter+1)**ndim, np.int64)
+    coords = np.zeros(ndim, np.int64)
+    for k in range(seeds.shape[0]):
+        queue[0] = seeds[k]
+        stamp[seeds[k]] = k
+        M[seeds[k]] = k+1
+        q0, q1 = 0, 1
+        for it in range(niter):
+            qend = q1
+            for q in range(q0, qend):
+                i = queue[q]
+                r = i
+                for d in range(ndim):
+                    coords[d] = r // strides[d]
+                    r -= coords[d] * strides[d]
+                for e in range(nexpand):
+                    inside = True
+                    j = 0
+                    for d in range(ndim):
+                        c = coords[d] + expand[e, d]
+                        if c < 0 or c >= shape[d]:
+                            inside = False
+                            break
+                        j += c * strides[d]
+                    if inside and stamp[j] != k and good[j]:
+                        stamp[j] = k
+                        M[j] = k+1
+                        queue[q1] = j
+                        q1 += 1
+            q0 = qend
+
+@njit(nogil=True, cache=True)
+def _unravel(i, shape, coords):
+    """ coordinates of flattened index i in array of shape (written to coords) """
+    for d in range(shape.shape[0]-1, -1, -1):
+        coords[d] = i % shape[d]
+        i //= shape[d]
+
+@njit(nogil=True, cache=True)
+def _sparse_lookup(ub, coords, shape):
+    """ index of bin at coords in sorted occupied bins ub, -1 if outside shape or not occupied """
+    j = 0
+    for d in range(shape.shape[0]):
+        if coords[d] < 0 or coords[d] >= shape[d]:
+            return -1
+        j = j * shape[d] + coords[d]
+    k = np.searchsorted(ub, j)
+    if k < ub.shape[0] and ub[k] == j:
+        return k
+    return -1
+
+@njit('Tuple((int64[:], int64[:]))(float32[:,:], int64[:], int64)', nogil=True, cache=True)
+def _sparse_bins(pf, shape0, rpad):
+    """ pixels that end up outside of their own bin and the (padded) bins they end up in
+
+    Parameters
+    ----------------
+
+    pf: float32, 2D array
+        final locations of each pixel after dynamics [axis x npixels]
+
+    shape0: int64, 1D array
+        shape of image
+
+    rpad: int64
+        histogram edge padding
+
+    Returns
+    ----------------
+
+    ipix: int64, 1D array
+        flattened indices of pixels that moved to another bin
+
+    bins: int64, 1D array
+        flattened indices of their bins in histogram of shape shape0+2*rpad
+
+    """
+    ndim, npix = pf.shape
+    coords = np.zeros(ndim, np.int64)
+    nmoved = 0
+    for i in range(npix):
+        _unravel(i, shape0, coords)
+        for d in range(ndim):
+            if np.int32(pf[d,i]) != coords[d]:
+                nmoved += 1
+                break
+    ipix = np.zeros(nmoved, np.int64)
+    bins = np.zeros(nmoved, np.int64)
+    n = 0
+    for i in range(npix):
+        _unravel(i, shape0, coords)
+        moved = False
+        for d in range(ndim):
+            if np.int32(pf[d,i]) != coords[d]:
+                moved = True
+        if moved:
+            j = 0
+            for d in range(ndim):
+                j = j * (shape0[d] + 2*rpad) + np.int32(pf[d,i]) + rpad
+            ipix[n] = i
+            bins[n] = j
+            n += 1
+    return ipix, bins
+
+@njit('int64[:](float32[:,:], int64[:], int64, int64[:], int64[:])', nogil=True, cache=True)
+def _sparse_static(pf, shape0, rpad, ub, counts):
+    """ add pixels that stay in their own bin to counts of occupied bins ub
+
+    Returns the flattened index of the pixel staying in each occupied bin 
+    (-1 if none), counts are updated in place.
+    """
+    ndim = shape0.shape[0]
+    shape = shape0 + 2*rpad
+    coords = np.zeros(ndim, np.int64)
+    static = np.full(ub.shape[0], -1, np.int64)
+    for k in range(ub.shape[0]):
+        _unravel(ub[k], shape, coords)
+        i = 0
+        inside = True
+        for d in range(ndim):
+            coords[d] -= rpad
+            if coords[d] < 0 or coords[d] >= shape0[d]:
+                inside = False
+            i = i * shape0[d] + coords[d]
+        if inside:
+            stays = True
+            for d in range(ndim):
+                if np.int32(pf[d,i]) != coords[d]:
+                    stays = False
+            if stays:
+                static[k] = i
+                counts[k] += 1
+    return static
+
+@njit('int64[:](int64[:], int64[:], int64[:], int64, int64)', nogil=True, cache=True)
+def _sparse_seeds(ub, counts, shape, width, min_count):
+    """ occupied bins that are maxima of counts in a box of size width and have more than min_count pixels """
+    ndim = shape.shape[0]
+    r = width // 2
+    nbox = width**ndim
+    coords = np.zeros(ndim, np.int64)
+    ncoords = np.zeros(ndim, np.int64)
+    isseed = np.zeros(ub.shape[0], np.bool_)
+    for k in range(ub.shape[0]):
+        if counts[k] <= min_count:
+            continue
+        _unravel(ub[k], shape, coords)
+        ismax = True
+        for e in range(nbox):
+            q = e
+            for d in range(ndim-1, -1, -1):
+                ncoords[d] = coords[d] + q % width - r
+                q //= width
+            kn = _sparse_lookup(ub, ncoords, shape)
+            if kn >= 0 and counts[kn] > counts[k]:
+                ismax = False
+                break
+        isseed[k] = ismax
+    return np.nonzero(isseed)[0]
+
+@njit('(int64[:], boolean[:], int64[:], int64[:], int32, int32[:])', nogil=True, cache=True)
+def _sparse_grow_seeds(ub, good, shape, seeds, niter, M):
+    """ same as `_grow_seeds` on the sorted occupied bins ub of a sparse histogram 
+    (seeds are indices into ub, masks M are given for each occupied bin) """
+    ndim = shape.shape[0]
+    nexpand = 3**ndim
+    coords = np.zeros(ndim, np.int64)
+    ncoords = np.zeros(ndim, np.int64)
+    stamp = np.full(ub.shape[0], -1, np.int64)
+    queue = np.zeros((2*niter+1)**ndim, np.int64)
+    for k in range(seeds.shape[0]):
+        queue[0] = seeds[k]
+        stamp[seeds[k]] = k
+        M[seeds[k]] = k+1
+        q0, q1 = 0, 1
+        for it in range(niter):
+            qend = q1
+            for q in range(q0, qend):
+                _unravel(ub[queue[q]], shape, coords)
+                for e in range(nexpand):
+                    r = e
+                    for d in range(ndim-1, -1, -1):
+                        ncoords[d] = coords[d] + r % 3 - 1
+                        r //= 3
+                    j = _sparse_lookup(ub, ncoords, shape)
+                    if j >= 0 and stamp[j] != k and good[j]:
+                        stamp[j] = k
+                        M[j] = k+1
+                        queue[q1] = j
+                        q1 += 1
+            q0 = qend
+
+def _get_masks_sparse(p, rpad=20):
+    """ masks from pixel convergence using a sparse histogram of final pixel locations
+
+    Only bins that pixels moved into are stored (memory scales with the number 
+    of moving pixels, not with the image volume). Seeds and masks are the same 
+    as with the dense histogram in `get_masks` (before removing big masks). 
+
+    Parameters
+    ----------------
+
+    p: float32, 3D or 4D array
+        final locations of each pixel after dynamics,
+        size [axis x Ly x Lx] or [axis x Lz x Ly x Lx].
+
+    rpad: int (optional, default 20)
+        histogram edge padding
+
+    Returns
+    ---------------
+
+    M0: int32, 2D or 3D array
+        masks, 0=NO masks; 1,2,...=mask labels (in order of seeds)
+
+    """
+    shape0 = np.array(p.shape[1:], np.int64)
+    shape = shape0 + 2*rpad
+    pf = p.reshape(len(p), -1).astype(np.float32, copy=False)
+    ipix, bins = _sparse_bins(pf, shape0, np.int64(rpad))
+    ub, inv, counts = np.unique(bins, return_inverse=True, return_counts=True)
+    counts = counts.astype(np.int64)
+    static = _sparse_static(pf, shape0, np.int64(rpad), ub, counts)
+    seeds = _sparse_seeds(ub, counts, shape, np.int64(5), np.int64(10))
+    Mb = np.zeros(len(ub), np.int32)
+    _sparse_grow_seeds(ub, counts>2, shape, seeds, np.int32(5), Mb)
+    M0 = np.zeros(pf.shape[1], np.int32)
+    M0[ipix] = Mb[inv.ravel()]
+    M0[static[static>=0]] = Mb[static>=0]
+    return M0.reshape(p.shape[1:])
+
+def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4, fused=True, sparse=False):
     """ create masks using pixel convergence after running dynamics
     
     Makes a histogram of final pixel locations p, initializes masks 
@@ -433,6 +1446,15 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
         is not None, then masks with inconsistent flows are removed using 
         `remove_bad_flow_masks`.
 
+    fused: bool (optional, default True)
+        grow all seeds in one compiled call (`_grow_seeds`) instead of 
+        looping over seeds in python (same output)
+
+    sparse: bool (optional, default False)
+        use a sparse histogram of the bins that pixels converge to instead 
+        of a dense histogram of the padded image (`_get_masks_sparse`), 
+        memory scales with the number of moving pixels (same output)
+
     Returns
     ---------------
 
@@ -457,71 +1479,365 @@ def get_masks(p, iscell=None, rpad=20, flows=None, threshold=0.4):
         for i in range(dims):
             p[i, ~iscell] = inds[i][~iscell]
 
-    for i in range(dims):
-        pflows.append(p[i].flatten().astype('int32'))
-        edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
-
-    h,_ = np.histogramdd(tuple(pflows), bins=edges)
-    hmax = h.copy()
-    for i in range(dims):
-        hmax = maximum_filter1d(hmax, 5, axis=i)
-
-    seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s = s[isort]
-
-    pix = list(np.array(seeds).T)
-
-    shape = h.shape
-    if dims==3:
-        expand = np.nonzero(np.ones((3,3,3)))
+    if sparse:
+        M0 = _get_masks_sparse(p, rpad=rpad)
     else:
-        expand = np.nonzero(np.ones((3,3)))
-    for e in expand:
-        e = np.expand_dims(e,1)
-
-    for iter in range(5):
-        for k in range(len(pix)):
-            if iter==0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i,e in enumerate(expand):
-                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                iin.append(np.logical_and(epix>=0, epix<shape[i]))
-                newpix.append(epix)
-            iin = np.all(tuple(iin), axis=0)
-            for p in newpix:
-                p = p[iin]
-            newpix = tuple(newpix)
-            igood = h[newpix]>2
-            for i in range(dims):
-                pix[k][i] = newpix[i][igood]
-            if iter==4:
-                pix[k] = tuple(pix[k])
-    
-    M = np.zeros(h.shape, np.int32)
-    for k in range(len(pix)):
-        M[pix[k]] = 1+k
+        for i in range(dims):
+            pflows.append(p[i].flatten().astype('int32'))
+            edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
+
+        h,_ = np.histogramdd(tuple(pflows), bins=edges)
+        hmax = h
+        for i in range(dims):
+            hmax = maximum_filter1d(hmax, 5, axis=i)
+
+        seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
+        Nmax = h[seeds]
+        isort = np.argsort(Nmax)[::-1]
+        for s in seeds:
+            s = s[isort]
+
+        M = np.zeros(h.shape, np.int32)
+        if fused:
+            seeds = np.ravel_multi_index(seeds, h.shape).astype(np.int64)
+            _grow_seeds((h>2).ravel(), np.array(h.shape, np.int64), seeds, np.int32(5), M.ravel())
+        else:
+            pix = list(np.array(seeds).T)
+
+            shape = h.shape
+            if dims==3:
+                expand = np.nonzero(np.ones((3,3,3)))
+            else:
+                expand = np.nonzero(np.ones((3,3)))
+            for e in expand:
+                e = np.expand_dims(e,1)
+
+            for iter in range(5):
+                for k in range(len(pix)):
+                    if iter==0:
+                        pix[k] = list(pix[k])
+                    newpix = []
+                    iin = []
+                    for i,e in enumerate(expand):
+                        epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
+                        epix = epix.flatten()
+                        iin.append(np.logical_and(epix>=0, epix<shape[i]))
+                        newpix.append(epix)
+                    iin = np.all(tuple(iin), axis=0)
+                    for p in newpix:
+                        p = p[iin]
+                    newpix = tuple(newpix)
+                    igood = h[newpix]>2
+                    for i in range(dims):
+                        pix[k][i] = newpix[i][igood]
+                    if iter==4:
+                        pix[k] = tuple(pix[k])
         
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    M0 = M[tuple(pflows)]
+            for k in range(len(pix)):
+                M[pix[k]] = 1+k
+        
+        for i in range(dims):
+            pflows[i] = pflows[i] + rpad
+        M0 = M[tuple(pflows)]
     
-    # remove big masks
-    _,counts = np.unique(M0, return_counts=True)
+    # remove big masks and relabel
     big = np.prod(shape0) * 0.4
-    for i in np.nonzero(counts > big)[0]:
-        M0[M0==i] = 0
-    _,M0 = np.unique(M0, return_inverse=True)
+    M0 = relabel.filter_sizes(M0, max_size=big)
     M0 = np.reshape(M0, shape0)
 
     if threshold is not None and threshold > 0 and flows is not None:
         M0 = remove_bad_flow_masks(M0, flows, threshold=threshold)
-        _,M0 = np.unique(M0, return_inverse=True)
-        M0 = np.reshape(M0, shape0).astype(np.int32)
+        M0 = relabel.relabel_sequential(M0)
+
+    return M0
+
+def _get_masks_chunk(dP, iscell, flows, niter, interp, tol, rpad, threshold, sparse):
+    """ run dynamics and create masks in one chunk (runs in worker processes) """
+    dP = np.array(dP, dtype=np.float32)
+    p = follow_flows(dP, niter=niter, interp=interp, tol=tol)
+    if flows is not None:
+        flows = np.array(flows, dtype=np.float32)
+    return get_masks(p, iscell=iscell, rpad=rpad, flows=flows, threshold=threshold, 
+                     sparse=sparse).astype(np.int32)
+
+def _chunk_slices(shape, chunk, overlap):
+    """ core and extended (core + overlap) slices of chunks covering shape in raster order """
+    chunk = np.broadcast_to(chunk, (len(shape),))
+    overlap = np.broadcast_to(overlap, (len(shape),))
+    starts = [range(0, L, int(c)) for L, c in zip(shape, chunk)]
+    slices = []
+    for start in np.array(np.meshgrid(*starts, indexing='ij')).reshape(len(shape), -1).T:
+        core = tuple(slice(s, min(s + c, L)) for s, c, L in zip(start, chunk, shape))
+        ext = tuple(slice(max(0, sl.start - o), min(L, sl.stop + o)) 
+                    for sl, o, L in zip(core, overlap, shape))
+        slices.append((core, ext))
+    return slices
+
+def _merge_chunk(M, masks, core, ext, nmasks, iou_threshold):
+    """ merge chunk masks into global masks M by overlap IoU, returns new number of masks
+
+    Chunk masks that do not reach the core of the chunk are dropped (they 
+    belong to a neighbouring chunk). Remaining chunk masks matching a 
+    global mask with IoU >= iou_threshold in the extended region take its 
+    label, all others get new labels. Pixels already labelled in M are not 
+    overwritten.
+
+    """
+    G = np.asarray(M[ext])
+    nlocal = int(masks.max())
+    if nlocal == 0:
+        return nmasks
+    core_local = tuple(slice(c.start - e.start, c.stop - e.start) for c, e in zip(core, ext))
+    keep = relabel.label_counts(masks[core_local], minlength=nlocal+1) > 0
+    keep[0] = False
+    # intersection of chunk masks with global masks already in the extended region
+    Gs, gcounts = relabel.relabel_sequential(G, return_counts=True)
+    lcounts = relabel.label_counts(masks, minlength=nlocal+1)
+    both = (masks > 0) & (Gs > 0)
+    lut = np.zeros(nlocal+1, np.int64)
+    if both.any():
+        ng = len(gcounts)
+        pairs, inter = np.unique(masks[both].astype(np.int64) * ng + Gs[both], return_counts=True)
+        il, ig = pairs // ng, pairs % ng
+        iou = inter / (lcounts[il] + gcounts[ig] - inter)
+        # best global match of each chunk mask
+        order = np.lexsort((iou, il))
+        last = np.r_[il[order][1:] != il[order][:-1], True]
+        il, ig, iou = il[order][last], ig[order][last], iou[order][last]
+        match = iou >= iou_threshold
+        glabels = np.zeros(ng, np.int64)
+        gpix = Gs > 0
+        glabels[Gs[gpix]] = G[gpix]
+        lut[il[match]] = glabels[ig[match]]
+    new = keep & (lut == 0)
+    lut[new] = nmasks + np.arange(1, new.sum()+1)
+    lut[~keep] = 0
+    write = (G == 0) & (masks > 0)
+    G[write] = lut[masks[write]]
+    M[ext] = G
+    return nmasks + int(new.sum())
+
+def get_masks_chunked(dP, iscell=None, chunk=1024, overlap=64, niter=200, interp=None, tol=None, 
+                      rpad=20, flows=None, threshold=0.4, sparse=False, iou_threshold=0.5, 
+                      n_workers=1, filename=None):
+    """ run dynamics and create masks in overlapping chunks and merge them across seams
+
+    Each chunk extended by overlap pixels on each side runs `follow_flows` 
+    and `get_masks` (in a process pool if n_workers > 1). Chunks are merged 
+    in raster order: a chunk mask that matches a mask of a previous chunk 
+    with IoU >= iou_threshold takes its label, otherwise it gets a new label. 
+    Only one chunk of flows and masks per worker is held in memory, dP can 
+    be a memory-mapped array (e.g. np.load(..., mmap_mode='r')) and masks 
+    are written to a memory-mapped file if filename is given. 
+    overlap should be larger than the diameter of the largest cell.
+
+    Parameters
+    ----------------
+
+    dP: float32, 3D or 4D array
+        flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
+
+    iscell: bool, 2D or 3D array (optional, default None)
+        if iscell is not None, set pixels that are 
+        iscell False to stay in their original location.
+
+    chunk: int or tuple of int (optional, default 1024)
+        size of chunk cores along each axis
+
+    overlap: int or tuple of int (optional, default 64)
+        number of pixels each chunk is extended by on each side
+
+    niter: int (optional, default 200)
+        number of iterations of dynamics to run
+
+    interp: bool (optional, default None)
+        interpolate during dynamics, if None True in 2D and False in 3D 
+        (see `follow_flows`)
+
+    tol: float (optional, default None)
+        convergence tolerance of dynamics (see `follow_flows`)
+
+    rpad: int (optional, default 20)
+        histogram edge padding
+
+    flows: float, 3D or 4D array (optional, default None)
+        flows predicted by the network [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
+        (can be memory-mapped, chunked like dP). If flows is not None, masks 
+        with inconsistent flows are removed in each chunk using 
+        `remove_bad_flow_masks` (as in `get_masks`)
+
+    threshold: float (optional, default 0.4)
+        masks with flow error greater than threshold are discarded 
+        (if flows is not None)
+
+    sparse: bool (optional, default False)
+        use sparse histogram in `get_masks`
 
-    return M0
\ No newline at end of file
+    iou_threshold: float (optional, default 0.5)
+        minimum IoU of masks of neighbouring chunks to be merged
+
+    n_workers: int (optional, default 1)
+        number of worker processes, chunks are run in this process if 1
+
+    filename: str (optional, default None)
+        if not None, masks are written to this .npy file (memory-mapped)
+
+    Returns
+    ---------------
+
+    M: int32, 2D or 3D array (np.memmap if filename is not None)
+        masks, 0=NO masks; 1,2,...=mask labels
+
+    """
+    shape = dP.shape[1:]
+    if filename is not None:
+        M = np.lib.format.open_memmap(filename, mode='w+', dtype=np.int32, shape=shape)
+    else:
+        M = np.zeros(shape, np.int32)
+    slices = _chunk_slices(shape, chunk, overlap)
+    args = lambda ext: (dP[(slice(None),) + ext], 
+                        None if iscell is None else np.asarray(iscell[ext]),
+                        None if flows is None else flows[(slice(None),) + ext],
+                        niter, interp, tol, rpad, threshold, sparse)
+    nmasks = 0
+    if n_workers > 1:
+        # at most 2 chunks per worker in flight to bound memory
+        # spawn workers, forking after numba/torch threads have started can deadlock
+        ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as pool:
+            futures = deque()
+            for core, ext in slices:
+                futures.append((core, ext, pool.submit(_get_masks_chunk, *args(ext))))
+                if len(futures) >= 2 * n_workers:
+                    core0, ext0, future = futures.popleft()
+                    nmasks = _merge_chunk(M, future.result(), core0, ext0, nmasks, iou_threshold)
+            while futures:
+                core0, ext0, future = futures.popleft()
+                nmasks = _merge_chunk(M, future.result(), core0, ext0, nmasks, iou_threshold)
+    else:
+        for core, ext in slices:
+            masks = _get_masks_chunk(*args(ext))
+            nmasks = _merge_chunk(M, masks, core, ext, nmasks, iou_threshold)
+    if filename is not None:
+        M.flush()
+    return M
+
+def estimate_volumes(volumes, sigma=3, min_volume=50):
+    """ robust mean and standard deviation of mask volumes
+
+    Volumes of at most min_volume are ignored, then outliers are removed 
+    by iteratively clipping at k standard deviations with k decreasing 
+    from 5 to sigma.
+
+    """
+    arr = volumes[volumes > min_volume]
+    if len(arr) == 0:
+        return 0., 0.
+    for k in np.linspace(5, sigma, 5):
+        std = arr.std()
+        dif = np.abs(arr - arr.mean())
+        arr = arr[dif < std * k]
+        if len(arr) == 0:
+            return 0., 0.
+    return arr.mean(), arr.std()
+
+def get_masks_pointer(dP, cellprob=None, level=0.5, grad=0.5, area=None, volume=None, 
+                      min_volume=50, max_jumps=32, return_niter=False):
+    """ create masks by rounding flows to pixel pointers and pointer jumping
+
+    Each pixel points to its neighbour in the direction of -dP (the 
+    direction pixels move in `follow_flows`), or to itself if cellprob < level 
+    or the flow norm is < grad. Pointers are replaced by the pointer they 
+    point to (p = p[p]) until no pointer changes, so after k jumps each 
+    pixel has followed 2^k steps. Connected components of the histogram of 
+    final pointers are masks, filtered by area (number of pixels that 
+    pixels converge to) and volume (number of pixels converging to them). 
+    Much faster than `follow_flows` + `get_masks` (2D and 3D), but less 
+    accurate for noisy flows since each step is rounded to a neighbour.
+
+    Parameters
+    ----------------
+
+    dP: float32, 3D or 4D array
+        flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
+
+    cellprob: float, 2D or 3D array (optional, default None)
+        cell probability, pixels with cellprob < level do not move
+
+    level: float (optional, default 0.5)
+        cell probability threshold
+
+    grad: float (optional, default 0.5)
+        pixels with flow norm < grad do not move
+
+    area: int (optional, default None)
+        masks with area >= area are discarded, if None masks with area 
+        >= volume // 3 are discarded (pixels converge to few locations)
+
+    volume: int (optional, default None)
+        masks with volume <= volume are discarded, if None estimated as 
+        max(mean - 3*std, min_volume) of mask volumes (`estimate_volumes`)
+
+    min_volume: int (optional, default 50)
+        minimum volume if volume is None
+
+    max_jumps: int (optional, default 32)
+        maximum number of jumps (pointers in cycles never converge)
+
+    return_niter: bool (optional, default False)
+        also return the number of jumps run
+
+    Returns
+    ---------------
+
+    M: int32, 2D or 3D array
+        masks, 0=NO masks; 1,2,...=mask labels
+
+    njumps: int
+        number of jumps run (only returned if return_niter)
+
+    """
+    dims = dP.shape[0]
+    shape = dP.shape[1:]
+    npix = int(np.prod(shape))
+    idtype = np.int32 if npix < 2**31 else np.int64
+    l = np.sqrt((dP.astype(np.float32)**2).sum(axis=0))
+    still = l < grad
+    if cellprob is not None:
+        still |= cellprob < level
+    # round normalized flows to steps of -1, 0 or 1 along each axis
+    rst = np.arange(npix, dtype=idtype).reshape(shape)
+    stride = 1
+    for i in range(dims-1, -1, -1):
+        step = (np.abs(dP[i]) >= 0.5 * l) * -np.sign(dP[i]).astype(np.int8)
+        step[still] = 0
+        # no steps out of the image
+        edges = [slice(None)] * dims
+        edges[i] = [0, -1]
+        step[tuple(edges)] = 0
+        rst += step.astype(idtype) * idtype(stride)
+        stride *= shape[i]
+    rst = rst.ravel()
+
+    # pointer jumping on pixels whose pointers still change
+    active = np.nonzero(rst != np.arange(npix, dtype=idtype))[0].astype(idtype)
+    njumps = 0
+    while len(active) > 0 and njumps < max_jumps:
+        old = rst[active]
+        new = rst[old]
+        rst[active] = new
+        active = active[new != old]
+        njumps += 1
+
+    hist = np.bincount(rst, minlength=npix).reshape(shape)
+    lab, n = scipy.ndimage.label(hist, np.ones((3,)*dims))
+    volumes = np.bincount(lab.ravel(), weights=hist.ravel(), minlength=n+1)
+    areas = np.bincount(lab.ravel(), minlength=n+1)
+    if volume is None:
+        mean, std = estimate_volumes(volumes, 2, min_volume=min_volume)
+        volume = max(mean - std * 3, min_volume)
+    if area is None:
+        area = volumes // 3
+    lut = relabel.sequential_lut((areas < area) & (volumes > volume))
+    M = lut[lab.ravel()[rst]].reshape(shape)
+    return (M, njumps) if return_niter else M
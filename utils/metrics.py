@@ -1,5 +1,5 @@
 import numpy as np
-from . import utils, dynamics
+from . import utils, dynamics, relabel
 from numba import jit
 from scipy.optimize import linear_sum_assignment
 from scipy.ndimage import convolve
@@ -233,18 +233,16 @@ def flow_error(maski, dP_net):
     if dP_net.shape[1:] != maski.shape:
         print('ERROR: net flow is not same size as predicted masks')
         return
-    maski = np.reshape(np.unique(maski.astype(np.float32), return_inverse=True)[1], maski.shape)
+    maski, npix = relabel.relabel_sequential(maski, return_counts=True)
     # flows predicted from estimated masks
     dP_masks,_ = dynamics.masks_to_flows(maski)
-    iun = np.unique(maski)[1:]
-    flow_errors=np.zeros((len(iun),))
-    for i,iu in enumerate(iun):
-        ii = maski==iu
-        if dP_masks.shape[0]==2:
-            flow_errors[i] += ((dP_masks[0][ii] - dP_net[0][ii]/5.)**2
-                            + (dP_masks[1][ii] - dP_net[1][ii]/5.)**2).mean()
-        else:
-            flow_errors[i] += ((dP_masks[0][ii] - dP_net[0][ii]/5.)**2 * 0.5
-                            + (dP_masks[1][ii] - dP_net[1][ii]/5.)**2
-                            + (dP_masks[2][ii] - dP_net[2][ii]/5.)**2).mean()
+    # squared error at each pixel, averaged over each mask with bincount
+    if dP_masks.shape[0]==2:
+        err = ((dP_masks[0] - dP_net[0]/5.)**2
+               + (dP_masks[1] - dP_net[1]/5.)**2)
+    else:
+        err = ((dP_masks[0] - dP_net[0]/5.)**2 * 0.5
+               + (dP_masks[1] - dP_net[1]/5.)**2
+               + (dP_masks[2] - dP_net[2]/5.)**2)
+    flow_errors = np.bincount(maski.ravel(), weights=err.ravel(), minlength=len(npix))[1:] / npix[1:]
     return flow_errors, dP_masks
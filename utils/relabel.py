@@ -0,0 +1,193 @@
+import numpy as np
+
+def label_counts(masks, minlength=0):
+    """ number of pixels of each label in masks
+
+    Parameters
+    ----------------
+
+    masks: int, ND-array
+        labelled masks, 0=NO masks; 1,2,...=mask labels
+
+    minlength: int (optional, default 0)
+        minimum length of the output
+
+    Returns
+    ----------------
+
+    counts: int64, 1D array
+        counts[i] is the number of pixels with label i
+
+    """
+    return np.bincount(masks.ravel(), minlength=minlength)
+
+def sequential_lut(keep, dtype=np.int32):
+    """ lookup table mapping kept labels to 1,2,... (in order) and all other labels to 0
+
+    Parameters
+    ----------------
+
+    keep: bool, 1D array
+        keep[i] is True if label i is kept (keep[0] is ignored, 0 always maps to 0)
+
+    dtype: numpy dtype (optional, default np.int32)
+        dtype of lookup table (and of masks relabelled with it)
+
+    Returns
+    ----------------
+
+    lut: 1D array
+        lut[i] is the new label of label i
+
+    """
+    keep = np.asarray(keep, bool).copy()
+    keep[:1] = False
+    lut = np.cumsum(keep, dtype=dtype)
+    lut *= keep
+    return lut
+
+def apply_lut(masks, lut, out=None):
+    """ relabel masks with lookup table, lut[masks] (in place if out is masks) """
+    return np.take(lut, masks, out=out)
+
+def relabel_sequential(masks, counts=None, return_counts=False, dtype=np.int32):
+    """ relabel masks to 1,2,...,nmasks keeping the order of labels
+
+    Same result as np.unique(masks, return_inverse=True) for masks with
+    background, but without sorting the image.
+
+    Parameters
+    ----------------
+
+    masks: int, ND-array
+        labelled masks, 0=NO masks; 1,2,...=mask labels
+
+    counts: int, 1D array (optional, default None)
+        label_counts(masks) if already computed
+
+    return_counts: bool (optional, default False)
+        also return the number of pixels of each new label
+
+    dtype: numpy dtype (optional, default np.int32)
+        dtype of relabelled masks
+
+    Returns
+    ----------------
+
+    masks: ND-array
+        relabelled masks
+
+    counts: int64, 1D array
+        number of pixels of each new label (if return_counts)
+
+    """
+    if counts is None:
+        counts = _counts_or_none(masks)
+    if counts is None:
+        # labels not integers or too sparse for bincount, fall back to sorting
+        uniq, masks_new = np.unique(masks, return_inverse=True)
+        if uniq.size > 0 and uniq[0] != 0:
+            masks_new += 1
+        masks_new = np.reshape(masks_new, masks.shape).astype(dtype)
+        if return_counts:
+            return masks_new, label_counts(masks_new)
+        return masks_new
+    keep = counts > 0
+    masks_new = apply_lut(masks, sequential_lut(keep, dtype=dtype))
+    if return_counts:
+        counts_new = np.concatenate(([counts[0]], counts[1:][keep[1:]]))
+        return masks_new, counts_new
+    return masks_new
+
+def remove_labels(masks, labels, relabel=False, out=None):
+    """ set masks with given labels to 0
+
+    Parameters
+    ----------------
+
+    masks: int, ND-array
+        labelled masks, 0=NO masks; 1,2,...=mask labels
+
+    labels: int, 1D array
+        labels to remove (labels not in masks are ignored)
+
+    relabel: bool (optional, default False)
+        relabel remaining masks to 1,2,...
+
+    out: ND-array (optional, default None)
+        output array, use out=masks to remove in place
+
+    Returns
+    ----------------
+
+    masks: ND-array
+        masks with labels removed
+
+    """
+    nmax = int(masks.max()) if masks.size > 0 else 0
+    labels = np.asarray(labels, np.int64).ravel()
+    labels = labels[(labels > 0) & (labels <= nmax)]
+    dtype = masks.dtype if out is None else out.dtype
+    if relabel:
+        keep = label_counts(masks, minlength=nmax+1) > 0
+        keep[labels] = False
+        lut = sequential_lut(keep, dtype=dtype)
+    else:
+        lut = np.arange(nmax+1, dtype=dtype)
+        lut[labels] = 0
+    return apply_lut(masks, lut, out=out)
+
+def filter_sizes(masks, min_size=None, max_size=None, relabel=True, counts=None, dtype=np.int32):
+    """ remove masks with fewer than min_size or more than max_size pixels
+
+    Parameters
+    ----------------
+
+    masks: int, ND-array
+        labelled masks, 0=NO masks; 1,2,...=mask labels
+
+    min_size: int (optional, default None)
+        masks with fewer pixels are removed, None for no minimum
+
+    max_size: int or float (optional, default None)
+        masks with more pixels are removed, None for no maximum
+
+    relabel: bool (optional, default True)
+        relabel remaining masks to 1,2,...
+
+    counts: int, 1D array (optional, default None)
+        label_counts(masks) if already computed
+
+    dtype: numpy dtype (optional, default np.int32)
+        dtype of output masks
+
+    Returns
+    ----------------
+
+    masks: ND-array
+        masks with small and big masks removed
+
+    """
+    if counts is None:
+        counts = label_counts(masks)
+    keep = counts > 0
+    if min_size is not None:
+        keep &= counts >= min_size
+    if max_size is not None:
+        keep &= counts <= max_size
+    if relabel:
+        lut = sequential_lut(keep, dtype=dtype)
+    else:
+        lut = np.arange(len(keep), dtype=dtype)
+        lut *= keep
+    return apply_lut(masks, lut)
+
+def _counts_or_none(masks):
+    """ label_counts(masks), or None if labels are not integers, negative or too sparse for bincount """
+    if masks.dtype.kind not in 'iub':
+        return None
+    if masks.size == 0:
+        return np.zeros(1, np.int64)
+    if masks.min() < 0 or masks.max() > 4 * masks.size + 1024:
+        return None
+    return label_counts(masks)
@@ -1,8 +1,13 @@
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import warnings
 import cv2
+import torch
 
+@functools.lru_cache(maxsize=16)
 def _taper_mask(ly=224, lx=224, sig=7.5):
+    """ taper mask for tiles (cached, read-only) """
     bsize = max(224, max(ly, lx))
     xm = np.arange(bsize)
     xm = np.abs(xm - xm.mean())
@@ -10,6 +15,7 @@ def _taper_mask(ly=224, lx=224, sig=7.5):
     mask = mask * mask[:, np.newaxis]
     mask = mask[bsize//2-ly//2 : bsize//2+ly//2+ly%2, 
                 bsize//2-lx//2 : bsize//2+lx//2+lx%2]
+    mask.flags.writeable = False
     return mask
 
 def unaugment_tiles(y, unet=False):
@@ -30,23 +36,98 @@ def unaugment_tiles(y, unet=False):
     y: float32
 
     """
+    # flip tile by tile (temporary copies stay in cache)
     for j in range(y.shape[0]):
         for i in range(y.shape[1]):
-            if j%2==0 and i%2==1:
-                y[j,i] = y[j,i, :,::-1, :]
-                if not unet:
-                    y[j,i,0] *= -1
-            elif j%2==1 and i%2==0:
-                y[j,i] = y[j,i, :,:, ::-1]
-                if not unet:
-                    y[j,i,1] *= -1
-            elif j%2==1 and i%2==1:
-                y[j,i] = y[j,i, :,::-1, ::-1]
-                if not unet:
-                    y[j,i,0] *= -1
-                    y[j,i,1] *= -1
+            if j%2==1 or i%2==1:
+                y[j,i] = y[j,i][_tile_flip(j, i)]
+    if not unet:
+        # tiles flipped in Y have Y flows negated, flipped in X have X flows negated
+        y[:, 1::2, 0] *= -1
+        y[1::2, :, 1] *= -1
     return y
 
+def _tile_flip(j, i):
+    """ slices flipping tile j, i [chan x Ly x Lx] of augmented tiles (its own inverse)
+
+    tiles in odd columns i are flipped in Y, tiles in odd rows j are flipped in X
+
+    """
+    return (slice(None), slice(None, None, -1 if i%2==1 else 1), 
+            slice(None, None, -1 if j%2==1 else 1))
+
+class TileAccumulator:
+    """ average results of network over tiles, adding tiles batch by batch
+
+    Tiles are weighted by a taper mask and summed into one output image, 
+    which is divided by the sum of the masks once in `result`, so only the 
+    output image and the current batch are in memory.
+
+    Parameters
+    -------------
+
+    ysub : list
+        list of arrays with start and end of tiles in Y of length ntiles
+
+    xsub : list
+        list of arrays with start and end of tiles in X of length ntiles
+
+    Ly : int
+        size of pre-tiled image in Y
+
+    Lx : int
+        size of pre-tiled image in X
+
+    nclasses : int
+        number of output channels of the network
+
+    augment : bool (optional, default False)
+        tiles were flipped by `make_tiles` with augment=True, flip them 
+        back (as in `unaugment_tiles`) before adding
+
+    nx : int (optional, default None)
+        number of tiles in X, IMG.shape[1] from `make_tiles` (required 
+        if augment)
+
+    unet : bool (optional, default False)
+        whether or not unet output or cellpose output (flows are not 
+        negated when flipping back unet output)
+
+    """
+    def __init__(self, ysub, xsub, Ly, Lx, nclasses, augment=False, nx=None, unet=False):
+        self.ysub = ysub
+        self.xsub = xsub
+        self.augment = augment
+        self.unet = unet
+        if augment and nx is None:
+            raise ValueError('nx is required to flip back augmented tiles')
+        self.nx = nx
+        self.yf = np.zeros((nclasses, Ly, Lx), np.float32)
+        self.Navg = np.zeros((Ly, Lx), np.float32)
+
+    def add(self, y, inds):
+        """ add network output y [len(inds) x nclasses x bsize x bsize] of tiles inds """
+        for b, k in enumerate(inds):
+            yk = y[b]
+            if self.augment:
+                j, i = divmod(k, self.nx)
+                yk = yk[_tile_flip(j, i)]
+            mask = _taper_mask(ly=yk.shape[-2], lx=yk.shape[-1])
+            ytile = yk * mask
+            if self.augment and not self.unet:
+                if i%2==1:
+                    ytile[0] *= -1
+                if j%2==1:
+                    ytile[1] *= -1
+            slc = (slice(self.ysub[k][0], self.ysub[k][1]), slice(self.xsub[k][0], self.xsub[k][1]))
+            self.yf[(slice(None),) + slc] += ytile
+            self.Navg[slc] += mask
+
+    def result(self):
+        """ network output averaged over tiles, float32 [nclasses x Ly x Lx] 
+        (new array, the accumulator can be added to and read again) """
+        return self.yf / self.Navg
+
 def average_tiles(y, ysub, xsub, Ly, Lx):
     """ average results of network over tiles
 
@@ -77,17 +158,85 @@ def average_tiles(y, ysub, xsub, Ly, Lx):
         network output averaged over tiles
 
     """
-    Navg = np.zeros((Ly,Lx))
-    yf = np.zeros((y.shape[1], Ly, Lx), np.float32)
-    # taper edges of tiles
-    mask = _taper_mask(ly=y.shape[-2], lx=y.shape[-1])
-    for j in range(len(ysub)):
-        yf[:, ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += y[j] * mask
-        Navg[ysub[j][0]:ysub[j][1],  xsub[j][0]:xsub[j][1]] += mask
-    yf /= Navg
-    return yf
-
-def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
+    acc = TileAccumulator(ysub, xsub, Ly, Lx, y.shape[1])
+    acc.add(y, range(len(ysub)))
+    return acc.result()
+
+class Tiles:
+    """ tiles of an image as views into the image, materialized in batches
+
+    Tiles are created by `make_tiles` with lazy=True. Tile k is at 
+    ysub[k], xsub[k] (row-major over the tile grid), flipped as in 
+    `make_tiles` if augment. np.asarray(tiles) gives the same array as 
+    `make_tiles` with lazy=False.
+
+    Parameters
+    ----------
+    imgi : float32
+        array that's nchan x Ly x Lx
+
+    ystart : int, 1D array
+        start of tiles in Y
+
+    xstart : int, 1D array
+        start of tiles in X
+
+    bsizeY : int
+        size of tiles in Y
+
+    bsizeX : int
+        size of tiles in X
+
+    augment : bool (optional, default False)
+        flip tiles for augmentation
+
+    """
+    def __init__(self, imgi, ystart, xstart, bsizeY, bsizeX, augment=False):
+        self.imgi = imgi
+        self.ystart = ystart
+        self.xstart = xstart
+        self.bsizeY = int(bsizeY)
+        self.bsizeX = int(bsizeX)
+        self.augment = augment
+        self.shape = (len(ystart), len(xstart), imgi.shape[0], self.bsizeY, self.bsizeX)
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def __getitem__(self, k):
+        """ view of tile k (no copy) """
+        j, i = divmod(k, self.shape[1])
+        tile = self.imgi[:, self.ystart[j]:self.ystart[j]+self.bsizeY, 
+                            self.xstart[i]:self.xstart[i]+self.bsizeX]
+        # flip tiles to allow for augmentation of overlapping segments
+        if self.augment:
+            tile = tile[_tile_flip(j, i)]
+        return tile
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def batch(self, inds, out=None):
+        """ copy tiles inds into float32 array that's len(inds) x nchan x bsizeY x bsizeX """
+        if out is None:
+            out = np.empty((len(inds),) + self.shape[2:], np.float32)
+        for b, k in enumerate(inds):
+            out[b] = self[k]
+        return out
+
+    def batches(self, batch_size=8):
+        """ iterate over batches of tiles, yields tile indices and float32 batch """
+        for k0 in range(0, len(self), batch_size):
+            inds = np.arange(k0, min(k0 + batch_size, len(self)))
+            yield inds, self.batch(inds)
+
+    def __array__(self, dtype=None, copy=None):
+        IMG = self.batch(np.arange(len(self))).reshape(self.shape)
+        return IMG if dtype is None else IMG.astype(dtype, copy=False)
+
+def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1, lazy=False):
     """ make tiles of image to run at test-time
 
     if augmented, tiles are flipped and tile_overlap=2.
@@ -110,10 +259,14 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
     tile_overlap: float (optional, default 0.1)
         fraction of overlap of tiles
 
+    lazy: bool (optional, default False)
+        return tiles as `Tiles` (views into imgi copied only when a batch 
+        of tiles is requested) instead of an array
+
     Returns
     -------
-    IMG : float32
-        array that's ntiles x nchan x bsize x bsize
+    IMG : float32 or Tiles
+        array that's ntiles_y x ntiles_x x nchan x bsize x bsize
 
     ysub : list
         list of arrays with start and end of tiles in Y of length ntiles
@@ -137,26 +290,7 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
         # tiles overlap by half of tile size
         ny = max(2, int(np.ceil(2. * Ly / bsize)))
         nx = max(2, int(np.ceil(2. * Lx / bsize)))
-        ystart = np.linspace(0, Ly-bsize, ny).astype(int)
-        xstart = np.linspace(0, Lx-bsize, nx).astype(int)
-
-        ysub = []
-        xsub = []
-
-        # flip tiles so that overlapping segments are processed in rotation
-        IMG = np.zeros((len(ystart), len(xstart), nchan,  bsize, bsize), np.float32)
-        for j in range(len(ystart)):
-            for i in range(len(xstart)):
-                ysub.append([ystart[j], ystart[j]+bsize])
-                xsub.append([xstart[i], xstart[i]+bsize])
-                IMG[j, i] = imgi[:, ysub[-1][0]:ysub[-1][1],  xsub[-1][0]:xsub[-1][1]]
-                # flip tiles to allow for augmentation of overlapping segments
-                if j%2==0 and i%2==1:
-                    IMG[j,i] = IMG[j,i, :,::-1, :]
-                elif j%2==1 and i%2==0:
-                    IMG[j,i] = IMG[j,i, :,:, ::-1]
-                elif j%2==1 and i%2==1:
-                    IMG[j,i] = IMG[j,i,:, ::-1, ::-1]
+        bsizeY, bsizeX = bsize, bsize
     else:
         tile_overlap = min(0.5, max(0.05, tile_overlap))
         bsizeY, bsizeX = min(bsize, Ly), min(bsize, Lx)
@@ -165,29 +299,139 @@ def make_tiles(imgi, bsize=224, augment=False, tile_overlap=0.1):
         # tiles overlap by 10% tile size
         ny = 1 if Ly<=bsize else int(np.ceil((1.+2*tile_overlap) * Ly / bsize))
         nx = 1 if Lx<=bsize else int(np.ceil((1.+2*tile_overlap) * Lx / bsize))
-        ystart = np.linspace(0, Ly-bsizeY, ny).astype(int)
-        xstart = np.linspace(0, Lx-bsizeX, nx).astype(int)
-
-        ysub = []
-        xsub = []
-        IMG = np.zeros((len(ystart), len(xstart), nchan,  bsizeY, bsizeX), np.float32)
-        for j in range(len(ystart)):
-            for i in range(len(xstart)):
-                ysub.append([ystart[j], ystart[j]+bsizeY])
-                xsub.append([xstart[i], xstart[i]+bsizeX])
-                IMG[j, i] = imgi[:, ysub[-1][0]:ysub[-1][1],  xsub[-1][0]:xsub[-1][1]]
-        
+    ystart = np.linspace(0, Ly-bsizeY, ny).astype(int)
+    xstart = np.linspace(0, Lx-bsizeX, nx).astype(int)
+
+    ysub = []
+    xsub = []
+    for j in range(len(ystart)):
+        for i in range(len(xstart)):
+            ysub.append([ystart[j], ystart[j]+bsizeY])
+            xsub.append([xstart[i], xstart[i]+bsizeX])
+
+    # flip tiles so that overlapping segments are processed in rotation
+    IMG = Tiles(imgi, ystart, xstart, bsizeY, bsizeX, augment=augment)
+    if not lazy:
+        IMG = np.asarray(IMG)
     return IMG, ysub, xsub, Ly, Lx
 
-def normalize99(img):
-    """ normalize image so 0.0 is 1st percentile and 1.0 is 99th percentile """
-    X = img.copy()
-    X = (X - np.percentile(X, 1)) / (np.percentile(X, 99) - np.percentile(X, 1))
-    return X
+def percentiles(img, q=(1, 99), approximate=False, max_samples=2**20):
+    """ percentiles of image intensities, all computed in one pass
+
+    Parameters
+    ------------
+
+    img: ND-array
+        image (any shape)
+
+    q: sequence of float (optional, default (1, 99))
+        percentiles to compute, between 0 and 100
+
+    approximate: bool (optional, default False)
+        if False, percentiles are computed with one np.percentile call (one partition 
+        of a copy of the image). If True, integer images with at most 2**20 different 
+        levels are histogrammed with np.bincount (same values as np.percentile, up to 
+        rounding of the interpolation), and all other images are subsampled with a 
+        stride (at most max_samples pixels) before np.percentile
+
+    max_samples: int (optional, default 2**20)
+        maximum number of pixels used for subsampled percentiles. The rank of each 
+        percentile is then within about sqrt(log(2/delta) / (2*max_samples)) of q/100 
+        with probability 1-delta (DKW bound for random samples, e.g. 0.26 percentile 
+        points at delta=1e-6 for 2**20 samples); strided samples are as accurate 
+        unless the image has structure periodic at the stride
+
+    Returns
+    ------------
+
+    p: float64, 1D array
+        percentiles of image [len(q)]
+
+    """
+    q = np.asarray(q, np.float64)
+    if not approximate or img.size <= max_samples:
+        return np.asarray(np.percentile(img, q), np.float64)
+    if img.dtype.kind in 'iu':
+        p = _percentiles_hist(img, q)
+        if p is not None:
+            return p
+    return np.asarray(np.percentile(_strided_sample(img, max_samples), q), np.float64)
+
+def _percentiles_hist(img, q, max_levels=2**20):
+    """ percentiles of integer image from histogram of its levels, None if too many levels """
+    x = img.reshape(-1)
+    if x.dtype.kind == 'u' and x.dtype.itemsize <= 2:
+        offset = 0
+        counts = np.bincount(x)
+    else:
+        offset, hi = int(x.min()), int(x.max())
+        if hi - offset >= max_levels:
+            return None
+        # subtract in int64, x - offset overflows for signed images spanning more than half the dtype range
+        counts = np.bincount((x.astype(np.int64) - offset) if offset != 0 else x)
+    cum = np.cumsum(counts)
+    # linear interpolation between sorted pixels k and k+1 at rank q/100*(n-1), as np.percentile
+    pos = q / 100. * (cum[-1] - 1)
+    k = np.floor(pos)
+    v0 = np.searchsorted(cum, k, side='right')
+    v1 = np.searchsorted(cum, np.minimum(k + 1, cum[-1] - 1), side='right')
+    return offset + v0 + (pos - k) * (v1 - v0)
+
+def _strided_sample(img, max_samples):
+    """ at most ~max_samples pixels of img taken with a stride (no copy of img) """
+    step = int(np.ceil(img.size / max_samples))
+    if img.flags.c_contiguous:
+        # avoid strides sampling the same columns in every row
+        while img.ndim > 1 and np.gcd(step, img.shape[-1]) > 1:
+            step += 1
+        return img.reshape(-1)[::step]
+    step = int(np.ceil(step ** (1. / img.ndim)))
+    return img[(slice(None, None, step),) * img.ndim]
+
+def normalize99(img, lower=1, upper=99, approximate=False, out=None):
+    """ normalize image so 0.0 is 1st percentile and 1.0 is 99th percentile 
+
+    Parameters
+    ------------
+
+    img: ND-array
+        image (any shape)
 
-def reshape(data, channels=[0,0], chan_first=False):
+    lower: float (optional, default 1)
+        percentile of image mapped to 0.0
+
+    upper: float (optional, default 99)
+        percentile of image mapped to 1.0
+
+    approximate: bool (optional, default False)
+        compute percentiles from histogram (integer images) or subsample (float images),
+        see `percentiles`
+
+    out: float ND-array (optional, default None)
+        output array, use out=img to normalize a float32 image in place
+
+    Returns
+    ------------
+
+    X: ND-array, float
+        normalized image
+
+    """
+    p = percentiles(img, (lower, upper), approximate=approximate)
+    if out is None:
+        out = np.empty(img.shape, img.dtype if img.dtype.kind == 'f' else np.float64)
+    # same arithmetic as (img - p0) / (p1 - p0) in the dtype of out
+    p0, p1 = p.astype(out.dtype)
+    np.subtract(img, p0, out=out)
+    np.divide(out, p1 - p0, out=out)
+    return out
+
+def reshape(data, channels=[0,0], chan_first=False, out=None, pool=None):
     """ reshape data using channels
 
+    Channels are selected (or averaged) from data before conversion to float32
+    and written directly into the output array.
+
     Parameters
     ----------
 
@@ -203,46 +447,59 @@ def reshape(data, channels=[0,0], chan_first=False):
     invert : bool
         invert intensities
 
+    out : float32 numpy array (optional, default None)
+        output array of size [2 x (Z x ) Ly x Lx] if chan_first else [(Z x ) Ly x Lx x 2]
+
+    pool : utils.cache.BufferPool (optional, default None)
+        if out is None, output array is taken from pool (reused by later calls with 
+        the same size) instead of allocated
+
     Returns
     -------
     data : numpy array that's (Z x ) Ly x Lx x nchan (if chan_first==False)
 
     """
-    data = data.astype(np.float32)
     if data.ndim < 3:
         data = data[:,:,np.newaxis]
     elif data.shape[0]<8 and data.ndim==3:
         data = np.transpose(data, (1,2,0))    
 
+    shape = (2,) + data.shape[:-1] if chan_first else data.shape[:-1] + (2,)
+    if out is None:
+        out = pool.get(shape, np.float32) if pool is not None else np.empty(shape, np.float32)
+    elif out.shape != shape or out.dtype != np.float32:
+        raise ValueError('out must be a float32 array of size %s'%(shape,))
+    # output channels
+    outc = out if chan_first else np.moveaxis(out, -1, 0)
+
     # use grayscale image
     if data.shape[-1]==1:
-        data = np.concatenate((data, np.zeros_like(data)), axis=-1)
+        outc[0] = data[...,0]
+        outc[1] = 0
     else:
         if channels[0]==0:
-            data = data.mean(axis=-1)
-            data = np.expand_dims(data, axis=-1)
-            data = np.concatenate((data, np.zeros_like(data)), axis=-1)
+            # mean over channels, summed in float32 as data.astype(np.float32).mean(axis=-1)
+            outc[0] = data[...,0]
+            for c in range(1, data.shape[-1]):
+                np.add(outc[0], data[...,c], out=outc[0], dtype=np.float32, casting='unsafe')
+            np.divide(outc[0], data.shape[-1], out=outc[0], casting='unsafe')
+            outc[1] = 0
         else:
             chanid = [channels[0]-1]
             if channels[1] > 0:
                 chanid.append(channels[1]-1)
-            data = data[...,chanid]
-            for i in range(data.shape[-1]):
-                if np.ptp(data[...,i]) == 0.0:
+            for i, c in enumerate(chanid):
+                outc[i] = data[...,c]
+                if np.ptp(outc[i]) == 0.0:
                     if i==0:
                         warnings.warn("chan to seg' has value range of ZERO")
                     else:
                         warnings.warn("'chan2 (opt)' has value range of ZERO, can instead set chan2 to 0")
-            if data.shape[-1]==1:
-                data = np.concatenate((data, np.zeros_like(data)), axis=-1)
-    if chan_first:
-        if data.ndim==4:
-            data = np.transpose(data, (3,0,1,2))
-        else:
-            data = np.transpose(data, (2,0,1))
-    return data
+            if len(chanid)==1:
+                outc[1] = 0
+    return out
 
-def normalize_img(img, axis=-1, invert=False):
+def normalize_img(img, axis=-1, invert=False, approximate=False, out=None):
     """ normalize each channel of the image so that so that 0.0=1st percentile
     and 1.0=99th percentile of image intensities
 
@@ -255,6 +512,13 @@ def normalize_img(img, axis=-1, invert=False):
 
     axis: channel axis to loop over for normalization
 
+    approximate: bool (optional, default False)
+        compute percentiles from histogram (integer images) or subsample (float images),
+        see `percentiles`
+
+    out: float32 ND-array (optional, default None)
+        output array of same size, use out=img to normalize a float32 image in place
+
     Returns
     ---------------
 
@@ -265,18 +529,26 @@ def normalize_img(img, axis=-1, invert=False):
     if img.ndim<3:
         raise ValueError('Image needs to have at least 3 dimensions')
 
-    img = img.astype(np.float32)
-    img = np.moveaxis(img, axis, 0)
+    # percentiles of integer images are computed before the float32 copy
+    img0 = np.moveaxis(img, axis, 0)
+    if out is None:
+        out = img.astype(np.float32)
+    elif out is not img:
+        np.copyto(out, img, casting='unsafe')
+    img = np.moveaxis(out, axis, 0)
     for k in range(img.shape[0]):
         if np.ptp(img[k]) > 0.0:
-            img[k] = normalize99(img[k])
+            p0, p1 = percentiles(img0[k], approximate=approximate).astype(np.float32)
+            # normalized in place
+            np.subtract(img[k], p0, out=img[k])
+            np.divide(img[k], p1 - p0, out=img[k])
             if invert:
-                img[k] = -1*img[k] + 1   
+                np.subtract(1, img[k], out=img[k])
     img = np.moveaxis(img, 0, axis)
     return img
 
 
-def reshape_and_normalize_data(train_data, channels=None, normalize=True):
+def reshape_and_normalize_data(train_data, channels=None, normalize=True, approximate=False, pool=None):
     """ inputs converted to correct shapes for *training* and rescaled so that 0.0=1st percentile
     and 1.0=99th percentile of image intensities in each channel
 
@@ -296,6 +568,13 @@ def reshape_and_normalize_data(train_data, channels=None, normalize=True):
     normalize: bool (optional, True)
         normalize data so 0.0=1st percentile and 1.0=99th percentile of image intensities in each channel
 
+    approximate: bool (optional, default False)
+        approximate percentiles for normalization (see `percentiles`)
+
+    pool: utils.cache.BufferPool (optional, default None)
+        if channels is not None, output is taken from pool (reused by later calls
+        with the same size, see `reshape`)
+
     Returns
     -------------
 
@@ -305,8 +584,9 @@ def reshape_and_normalize_data(train_data, channels=None, normalize=True):
     """
 
     # if training data is less than 2D
-    if channels is not None:
-        train_data = reshape(train_data, channels=channels, chan_first=True)
+    reshaped = channels is not None
+    if reshaped:
+        train_data = reshape(train_data, channels=channels, chan_first=True, pool=pool)
     if train_data.ndim < 3:
         train_data = train_data[:,:,np.newaxis]
     elif train_data.shape[-1] < 8:
@@ -314,11 +594,14 @@ def reshape_and_normalize_data(train_data, channels=None, normalize=True):
         train_data = np.transpose(train_data, (2,0,1))
 
     if normalize:
-        train_data = normalize_img(train_data, axis=0)
+        # output of reshape is normalized in place
+        train_data = normalize_img(train_data, axis=0, approximate=approximate, 
+                                   out=train_data if reshaped else None)
 
     return train_data
 
-def resize_image(img0, Ly=None, Lx=None, rsz=None, interpolation=cv2.INTER_LINEAR):
+def resize_image(img0, Ly=None, Lx=None, rsz=None, interpolation=cv2.INTER_LINEAR, 
+                 n_workers=1, keep_dtype=False, out=None):
     """ resize image for computing flows / unresize for computing dynamics
 
     Parameters
@@ -336,6 +619,18 @@ def resize_image(img0, Ly=None, Lx=None, rsz=None, interpolation=cv2.INTER_LINEA
 
     interpolation: cv2 interp method (optional, default cv2.INTER_LINEAR)
 
+    n_workers: int (optional, default 1)
+        number of threads resizing planes of [Lz x y x x x nchan] images 
+        (cv2.resize releases the GIL)
+
+    keep_dtype: bool (optional, default False)
+        [Lz x y x x x nchan] images are resized to arrays of the dtype of img0 
+        instead of float32 (images of size [y x x x nchan] always keep their dtype)
+
+    out: ND-array (optional, default None)
+        output array of size [Ly x Lx x nchan] or [Lz x Ly x Lx x nchan], e.g. a 
+        memory-mapped array, planes are written into it one at a time
+
     Returns
     --------------
 
@@ -354,14 +649,29 @@ def resize_image(img0, Ly=None, Lx=None, rsz=None, interpolation=cv2.INTER_LINEA
         Lx = int(img0.shape[-2] * rsz[-1])
     
     if img0.ndim==4:
-        imgs = np.zeros((img0.shape[0], Ly, Lx, img0.shape[-1]), np.float32)
-        for i,img in enumerate(img0):
-            imgs[i] = cv2.resize(img, (Lx, Ly), interpolation=interpolation)
+        if out is None:
+            imgs = np.empty((img0.shape[0], Ly, Lx, img0.shape[-1]), 
+                            img0.dtype if keep_dtype else np.float32)
+        else:
+            imgs = out
+        def resize_plane(i):
+            # cv2 drops single channel axis
+            imgs[i] = cv2.resize(img0[i], (Lx, Ly), interpolation=interpolation).reshape(imgs.shape[1:])
+        if n_workers > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                for _ in pool.map(resize_plane, range(img0.shape[0])):
+                    pass
+        else:
+            for i in range(img0.shape[0]):
+                resize_plane(i)
     else:
         imgs = cv2.resize(img0, (Lx, Ly), interpolation=interpolation)
+        if out is not None:
+            out[:] = imgs.reshape(out.shape)
+            imgs = out
     return imgs
 
-def pad_image_ND(img0, div=16, extra = 1):
+def pad_image_ND(img0, div=16, extra = 1, pool=None):
     """ pad image for test-time so that its dimensions are a multiple of 16 (2D or 3D)
 
     Parameters
@@ -372,11 +682,15 @@ def pad_image_ND(img0, div=16, extra = 1):
 
     div: int (optional, default 16)
 
+    pool: utils.cache.BufferPool or TorchBufferPool (optional, default None)
+        if not None, image is padded into an array (or pinned tensor) from pool, 
+        reused by later calls with the same padded size, instead of with np.pad
+
     Returns
     --------------
 
     I: ND-array
-        padded image
+        padded image (array or tensor from pool if pool is not None)
 
     ysub: array, int
         yrange of pixels in I corresponding to img0
@@ -397,7 +711,12 @@ def pad_image_ND(img0, div=16, extra = 1):
     else:
         pads = np.array([[0,0], [xpad1,xpad2], [ypad1, ypad2]])
 
-    I = np.pad(img0,pads, mode='constant')
+    if pool is None:
+        I = np.pad(img0,pads, mode='constant')
+    else:
+        shape = tuple(n + p.sum() for n, p in zip(img0.shape, pads))
+        I = pool.get(shape, img0.dtype)
+        _pad_into(I if isinstance(I, np.ndarray) else I.numpy(), img0, xpad1, ypad1)
 
     Ly, Lx = img0.shape[-2:]
     ysub = np.arange(xpad1, xpad1+Ly)
@@ -411,8 +730,17 @@ def pad_image_ND(img0, div=16, extra = 1):
 
     return I, slc
 
+def _pad_into(I, img0, y0, x0):
+    """ copy img0 into I at (y0, x0) in last two axes and zero the rest of I """
+    Ly, Lx = img0.shape[-2:]
+    I[..., :y0, :] = 0
+    I[..., y0+Ly:, :] = 0
+    I[..., y0:y0+Ly, :x0] = 0
+    I[..., y0:y0+Ly, x0+Lx:] = 0
+    I[..., y0:y0+Ly, x0:x0+Lx] = img0
+
 def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224), 
-                             do_flip=True, rescale=None, unet=False):
+                             do_flip=True, rescale=None, unet=False, fused=True):
     """ augmentation by random rotation and resizing
 
         X and Y are lists or arrays of length nimg, with dims channels x Ly x Lx (channels optional)
@@ -425,7 +753,8 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224),
         Y: ND-arrays, float (optional, default None)
             image labels of size [nlabels x Ly x Lx] or [Ly x Lx]. The 1st channel
             of Y is always nearest-neighbor interpolated (assumed to be masks or 0-1 representation).
-            If Y.shape[0]==3 and not unet, then the labels are assumed to be [cell probability, Y flow, X flow]. 
+            If Y.shape[0]==3 and not unet, then the labels are assumed to be [cell probability, Y flow, X flow]
+            (CellDataset reorders the [Y flow, X flow, cell probability] of `labels_to_flows`). 
             If unet, second channel is dist_to_bound.
 
         scale_range: float (optional, default 1.0)
@@ -443,6 +772,12 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224),
 
         unet: bool (optional, default False)
 
+        fused: bool (optional, default True)
+            warp all image channels in one channels-last call of cv2.warpAffine 
+            (and labels in one nearest and one linear call), with the flip folded 
+            into the affine transform and flows rotated in place, instead of 
+            one call per channel
+
         Returns
         -------
         imgi: ND-array, float
@@ -456,20 +791,6 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224),
 
     """
     scale_range = max(0, min(2, float(scale_range)))
-    if X.ndim>2:
-        nchan = X.shape[0]
-    else:
-        nchan = 1
-    imgi  = np.zeros((nchan, xy[0], xy[1]), np.float32)
-
-    lbl = []
-    if Y is not None:
-        if Y.ndim>2:
-            nt = Y.shape[0]
-        else:
-            nt = 1
-        lbl = np.zeros((nt, xy[0], xy[1]), np.float32)
-
     Ly, Lx = X.shape[-2:]
 
     # generate random augmentation parameters
@@ -490,6 +811,23 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224),
             cc1 + scale*np.array([np.cos(np.pi/2+theta), np.sin(np.pi/2+theta)])])
     M = cv2.getAffineTransform(pts1,pts2)
 
+    if fused:
+        return _warp_fused(X, Y, M, theta, flip and do_flip, xy, unet)
+
+    if X.ndim>2:
+        nchan = X.shape[0]
+    else:
+        nchan = 1
+    imgi  = np.zeros((nchan, xy[0], xy[1]), np.float32)
+
+    lbl = []
+    if Y is not None:
+        if Y.ndim>2:
+            nt = Y.shape[0]
+        else:
+            nt = 1
+        lbl = np.zeros((nt, xy[0], xy[1]), np.float32)
+
     img = X.copy()
     if Y is not None:
         labels = Y.copy()
@@ -515,13 +853,182 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., xy = (224,224),
                 lbl[k] = cv2.warpAffine(labels[k], M, (xy[1],xy[0]), flags=cv2.INTER_LINEAR)
 
         if nt > 1 and not unet:
-            v1 = lbl[1].copy()
-            v2 = lbl[0].copy()
-            lbl[0] = (-v1 * np.sin(-theta) + v2*np.cos(-theta))
-            lbl[1] = (v1 * np.cos(-theta) + v2*np.sin(-theta))
+            v1 = lbl[2].copy()
+            v2 = lbl[1].copy()
+            lbl[1] = (-v1 * np.sin(-theta) + v2*np.cos(-theta))
+            lbl[2] = (v1 * np.cos(-theta) + v2*np.sin(-theta))
 
     return imgi, lbl
 
+def _warp_fused(X, Y, M, theta, flip, xy, unet):
+    """ warp image and labels with affine transform M in one call per interpolation
+    (see `random_rotate_and_resize`)
+
+    labels are [cell probability, Y flow, X flow]: Y[0] is nearest-interpolated,
+    Y[2] (X flow) is negated if flip and Y[1:3] are rotated by theta
+    """
+    Ly, Lx = X.shape[-2:]
+    if flip:
+        # sample from Lx-1-x instead of flipping the arrays
+        M = M.copy()
+        M[:, 2] += M[:, 0] * (Lx - 1)
+        M[:, 0] *= -1
+    dsize = (xy[1], xy[0])
+
+    img = X if X.ndim > 2 else X[np.newaxis]
+    nchan = img.shape[0]
+    imgi = np.empty((nchan, xy[0], xy[1]), np.float32)
+    outs = list(imgi)
+    planes = list(img)
+    lbl = []
+    if Y is not None:
+        labels = Y if Y.ndim > 2 else Y[np.newaxis]
+        nt = labels.shape[0]
+        lbl = np.empty((nt, xy[0], xy[1]), np.float32)
+        lbl[0] = cv2.warpAffine(np.ascontiguousarray(labels[0], dtype=np.float32), M, dsize, 
+                                flags=cv2.INTER_NEAREST)
+        outs += list(lbl[1:])
+        planes += list(labels[1:])
+
+    # image and linear label channels interleaved (channels-last) and warped in one call,
+    # cv2 has fast paths for 3 and 4 channels (2 channels of image + 2 flows)
+    planes = [np.ascontiguousarray(p, dtype=np.float32) for p in planes]
+    warped = cv2.warpAffine(cv2.merge(planes), M, dsize, flags=cv2.INTER_LINEAR)
+    if len(outs) > 1:
+        cv2.split(warped, outs)
+    else:
+        outs[0][:] = warped
+
+    if Y is not None and nt > 2 and not unet:
+        # rotate flows in place, X flow is negated if flipped:
+        # (lbl[1], lbl[2]) = (v1*sin + v2*cos, v1*cos - v2*sin) with v1 = +-lbl[2], v2 = lbl[1]
+        sign = -1. if flip else 1.
+        sin, cos = np.float32(np.sin(theta)), np.float32(np.cos(theta))
+        v2 = lbl[1].copy()
+        lbl[1] *= cos
+        lbl[1] += (sign * sin) * lbl[2]
+        lbl[2] *= sign * cos
+        v2 *= sin
+        lbl[2] -= v2
+
+    return imgi, lbl
+
+def random_rotate_and_resize_torch(X, Y=None, shapes=None, scale_range=1., xy=(224,224), 
+                                   do_flip=True, rescale=None, unet=False):
+    """ augmentation by random rotation and resizing of a batch with torch
+
+        Same augmentations as `random_rotate_and_resize` for a whole batch in 
+        two calls of grid_sample (linear and nearest) on the device of X.
+
+        Parameters
+        ----------
+        X: torch tensor, float
+            images of size [nimg x nchan x Ly x Lx], zero-padded at the bottom 
+            and right if images have different sizes (see shapes)
+
+        Y: torch tensor, float (optional, default None)
+            labels of size [nimg x nlabels x Ly x Lx]. The 1st channel
+            of Y is always nearest-neighbor interpolated (assumed to be masks or 0-1 representation).
+            If Y.shape[1]==3 and not unet, then the labels are assumed to be [cell probability, Y flow, X flow]
+            (the order returned by CellDataset with batch_augment, not the order of `labels_to_flows`). 
+
+        shapes: int, array or tensor (optional, default None)
+            size [nimg x 2] of images before padding, X.shape[-2:] if None
+
+        scale_range: float (optional, default 1.0)
+            Range of resizing of images for augmentation. Images are resized by
+            (1-scale_range/2) + scale_range * np.random.rand()
+
+        xy: tuple, int (optional, default (224,224))
+            size of transformed images to return
+
+        do_flip: bool (optional, default True)
+            whether or not to flip images horizontally
+
+        rescale: array, float (optional, default None)
+            how much to resize images by before performing augmentations
+
+        unet: bool (optional, default False)
+
+        Returns
+        -------
+        imgi: torch tensor, float
+            transformed images [nimg x nchan x xy[0] x xy[1]]
+
+        lbl: torch tensor, float
+            transformed labels [nimg x nlabels x xy[0] x xy[1]] (None if Y is None)
+
+        scale: array, float
+            amount each image was resized by
+
+    """
+    scale_range = max(0, min(2, float(scale_range)))
+    nimg = X.shape[0]
+    H, W = X.shape[-2:]
+    if shapes is None:
+        shapes = np.tile(np.array([H, W]), (nimg, 1))
+    shapes = np.asarray(shapes.cpu() if torch.is_tensor(shapes) else shapes, np.float64)
+
+    # affine transforms from output pixels to input pixels with align_corners=True
+    # normalized coordinates, theta = norm_in @ inv(M) @ flip @ unnorm_out
+    unnorm_out = np.array([[(xy[1]-1)/2, 0, (xy[1]-1)/2], 
+                           [0, (xy[0]-1)/2, (xy[0]-1)/2], 
+                           [0, 0, 1]])
+    norm_in = np.array([[2/max(1, W-1), 0, -1], 
+                        [0, 2/max(1, H-1), -1], 
+                        [0, 0, 1]])
+    theta = np.zeros((nimg, 2, 3))
+    thetas = np.zeros(nimg)
+    scale = np.zeros(nimg)
+    flips = np.zeros(nimg, bool)
+    for n in range(nimg):
+        Ly, Lx = shapes[n]
+        # generate random augmentation parameters
+        flip = np.random.rand()>.5
+        thetas[n] = np.random.rand() * np.pi * 2
+        scale[n] = (1-scale_range/2) + scale_range * np.random.rand()
+        if rescale is not None:
+            scale[n] *= 1. / rescale[n]
+        dxy = np.maximum(0, np.array([Lx*scale[n]-xy[1],Ly*scale[n]-xy[0]]))
+        dxy = (np.random.rand(2,) - .5) * dxy
+
+        # inverse of affine transform from input to output
+        cc = np.array([Lx/2, Ly/2])
+        cc1 = cc - np.array([Lx-xy[1], Ly-xy[0]])/2 + dxy
+        c, s = np.cos(thetas[n]), np.sin(thetas[n])
+        Ainv = np.array([[c, s], [-s, c]]) / scale[n]
+        Minv = np.eye(3)
+        Minv[:2, :2] = Ainv
+        Minv[:2, 2] = cc - Ainv @ cc1
+        flips[n] = flip and do_flip
+        if flips[n]:
+            Minv = np.array([[-1, 0, Lx-1], [0, 1, 0], [0, 0, 1]]) @ Minv
+        theta[n] = (norm_in @ Minv @ unnorm_out)[:2]
+
+    theta = torch.from_numpy(theta).to(device=X.device, dtype=X.dtype)
+    grid = torch.nn.functional.affine_grid(theta, (nimg, 1, xy[0], xy[1]), align_corners=True)
+    sample = lambda I, mode: torch.nn.functional.grid_sample(I, grid, mode=mode, 
+                                                             padding_mode='zeros', align_corners=True)
+    if Y is None:
+        return sample(X, 'bilinear'), None, scale
+
+    # images and labels after the first are linearly interpolated in one call
+    nchan, nt = X.shape[1], Y.shape[1]
+    Y = Y.to(X.dtype)
+    out = sample(torch.cat((X, Y[:, 1:]), dim=1), 'bilinear')
+    imgi, lbl = out[:, :nchan], torch.cat((sample(Y[:, :1], 'nearest'), out[:, nchan:]), dim=1)
+
+    if nt > 2 and not unet:
+        # X flow of flipped images is negated, then flows are rotated
+        sign = torch.from_numpy(np.where(flips, -1., 1.)).to(lbl)[:, None, None]
+        th = torch.from_numpy(-thetas).to(lbl)[:, None, None]
+        v1 = lbl[:, 2] * sign
+        v2 = lbl[:, 1].clone()
+        lbl[:, 1] = -v1 * torch.sin(th) + v2 * torch.cos(th)
+        lbl[:, 2] = v1 * torch.cos(th) + v2 * torch.sin(th)
+
+    return imgi, lbl, scale
+
 
 def _X2zoom(img, X2=1):
     """ zoom in image
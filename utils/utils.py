@@ -7,7 +7,7 @@ from scipy.spatial import ConvexHull
 import numpy as np
 import colorsys
 
-from . import metrics
+from . import metrics, relabel
 
 def rgb_to_hsv(arr):
     rgb_to_hsv_channels = np.vectorize(colorsys.rgb_to_hsv)
@@ -280,10 +280,7 @@ def get_masks_unet(output, cell_threshold=0, boundary_threshold=0):
                 mins[slc_pad][dists[slc_pad]==msk] = (i+1)
         labels[labels==0] = borders[labels==0] * mins[labels==0]
         
-    masks = labels
-    shape0 = masks.shape
-    _,masks = np.unique(masks, return_inverse=True)
-    masks = np.reshape(masks, shape0)
+    masks = relabel.relabel_sequential(labels)
     return masks
 
 def stitch3D(masks, stitch_threshold=0.25):